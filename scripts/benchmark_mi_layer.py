@@ -0,0 +1,60 @@
+"""
+Compares activation memory (bytes saved for backward) and speed of MILayer implementations
+"""
+
+import sys; sys.path.append('.')
+import argparse
+from time import perf_counter
+
+import torch
+
+from src.models.layers import MILayer
+
+
+def measure(layer: MILayer, x: torch.Tensor, z: torch.Tensor, num_runs: int=10):
+    saved_num_bytes = 0
+
+    def pack(t: torch.Tensor) -> torch.Tensor:
+        nonlocal saved_num_bytes
+        saved_num_bytes += t.numel() * t.element_size()
+
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        layer(x, z).sum().backward()
+
+    start = perf_counter()
+
+    for _ in range(num_runs):
+        layer(x, z).sum().backward()
+
+    if x.is_cuda: torch.cuda.synchronize()
+
+    return saved_num_bytes, (perf_counter() - start) / num_runs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('MILayer benchmark')
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--x_dim', type=int, default=512)
+    parser.add_argument('--z_dim', type=int, default=312)
+    parser.add_argument('--out_dim', type=int, default=512)
+    parser.add_argument('--rank', type=int, default=32)
+    parser.add_argument('--chunk_size', type=int, default=64)
+    parser.add_argument('--device', type=str, default=('cuda' if torch.cuda.is_available() else 'cpu'))
+    args = parser.parse_args()
+
+    x = torch.randn(args.batch_size, args.x_dim, device=args.device)
+    z = torch.randn(args.batch_size, args.z_dim, device=args.device)
+    setups = [('matmul', None, None), ('einsum', None, None), ('einsum', None, args.chunk_size), ('einsum', args.rank, None)]
+
+    print('Note: unchunked einsum still keeps a [batch_size, d1, d2] per-sample intermediate (the smallest pair of dims) for backward, ' \
+          'chunked one recomputes [batch_size, chunk_size, ...] intermediates in backward instead')
+
+    for impl, rank, chunk_size in setups:
+        layer = MILayer(args.x_dim, args.z_dim, args.out_dim, rank=rank, impl=impl, chunk_size=chunk_size).to(args.device)
+        num_params = sum(p.numel() for p in layer.parameters())
+        saved_num_bytes, time_per_run = measure(layer, x, z)
+
+        print(f'[{impl}, rank={rank}, chunk_size={chunk_size}] params: {num_params}, ' \
+              f'saved for backward: {saved_num_bytes / 2 ** 20:.1f} MB, time: {time_per_run * 1000:.1f} ms')
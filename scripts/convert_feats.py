@@ -0,0 +1,22 @@
+"""
+Converts pickled features files (`{split}_{input_type}.npy` with (feat, label) pairs)
+into directories with separate memory-mappable feats and labels arrays
+"""
+
+import sys; sys.path.append('.')
+import os
+import argparse
+
+import numpy as np
+
+from src.dataloaders.feats import convert_pickled_feats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Features files converter')
+    parser.add_argument('files', nargs='+', help='Pickled features files to convert')
+    parser.add_argument('--float16', action='store_true', help='Keep the features in float16')
+    args = parser.parse_args()
+
+    for file_path in args.files:
+        convert_pickled_feats(file_path, os.path.splitext(file_path)[0], dtype=(np.float16 if args.float16 else np.float32))
@@ -7,8 +7,7 @@ from typing import List, Tuple
 import numpy as np
 
 from src.utils.constants import DEBUG
-from src.dataloaders.utils import read_column, create_default_transform
-from src.dataloaders.dataset import ImageDataset
+from src.dataloaders.utils import read_column, build_image_dataset
 
 
 def load_dataset_paths(data_dir: PathLike, split: str) -> List[Tuple[os.PathLike, int]]:
@@ -29,11 +28,14 @@ def load_dataset_paths(data_dir: PathLike, split: str) -> List[Tuple[os.PathLike
 
 def load_dataset(data_dir: PathLike,
                  split: str,
-                 target_shape: Tuple[int, int]=None) -> List[Tuple[np.ndarray, int]]:
+                 target_shape: Tuple[int, int]=None,
+                 shards_dir: PathLike=None,
+                 normalize_in_collate: bool=False) -> List[Tuple[np.ndarray, int]]:
 
     img_paths, labels = zip(*load_dataset_paths(data_dir, split))
 
-    return ImageDataset(img_paths, labels, create_default_transform(target_shape))
+    return build_image_dataset(img_paths, labels, 'AWA', split, target_shape,
+                               shards_dir=shards_dir, normalize_in_collate=normalize_in_collate)
 
 
 def load_class_attributes(data_dir: PathLike) -> np.ndarray:
@@ -4,14 +4,19 @@ from typing import Tuple
 import numpy as np
 from torchvision.datasets import CIFAR10, CIFAR100
 
-from src.dataloaders.utils import shuffle_dataset
+from src.dataloaders.dataset import ArrayDataset
 
 dataset_classes = {10: CIFAR10, 100: CIFAR100}
 
-def load_dataset(data_dir: os.PathLike, split: str, num_classes: int=10):
+def load_dataset(data_dir: os.PathLike, split: str, num_classes: int=10) -> ArrayDataset:
     ds = dataset_classes[num_classes](data_dir, train=(split == 'train'))
-    imgs = [(x / 127.5 - 1).astype(np.float32).transpose(2, 0, 1) for x in ds.data]
-    # imgs = [(x / 255).astype(np.float32).transpose(2, 0, 1) for x in ds.data]
-    ds = list(zip(*shuffle_dataset(imgs, ds.targets)))
+    # We keep the images as a single uint8 array and normalize them batch-wise
+    ds = ArrayDataset(np.ascontiguousarray(ds.data), np.array(ds.targets, dtype=np.int64), normalize_imgs)
+    ds = ds.get_subset(np.random.permutation(len(ds)))
 
     return ds
+
+
+def normalize_imgs(imgs: np.ndarray) -> np.ndarray:
+    return (imgs / 127.5 - 1).astype(np.float32).transpose(0, 3, 1, 2)
+    # return (imgs / 255).astype(np.float32).transpose(0, 3, 1, 2)
@@ -2,19 +2,101 @@ from os import PathLike
 from typing import List, Callable, Tuple, Iterable
 
 import numpy as np
+import torch
 from torch.utils.data import Dataset
 
 from src.dataloaders.utils import load_img, load_imgs
 
 
+class ArrayDataset(Dataset):
+    """
+    Dataset over a contiguous (possibly memory-mapped) array of samples and an array of labels.
+    Subsets are kept as indices into the same array, so nothing is copied.
+    The transform is applied to a whole batch at once, when the dataloader fetches the samples via `__getitems__`.
+    """
+    def __init__(self, data: np.ndarray, labels: np.ndarray, batch_transform: Callable=None,
+                 idx: np.ndarray=None, collate_fn: Callable=None):
+        self.data = data
+        self.collate_fn = collate_fn
+        self.all_labels = np.asarray(labels)
+        self.batch_transform = batch_transform
+        self.idx = np.arange(len(self.all_labels)) if idx is None else np.asarray(idx, dtype=int)
+        self.labels = self.all_labels[self.idx]
+
+    def maybe_transform(self, x: np.ndarray) -> np.ndarray:
+        if self.batch_transform is None:
+            return x
+        else:
+            return self.batch_transform(x)
+
+    def __getitem__(self, idx) -> Tuple[np.ndarray, int]:
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, idx: List[int]) -> List[Tuple[np.ndarray, int]]:
+        idx = np.asarray(idx, dtype=int)
+        x = self.maybe_transform(self.data[self.idx[idx]])
+
+        return list(zip(x, self.labels[idx].tolist()))
+
+    def __len__(self) -> int:
+        return len(self.idx)
+
+    def load_all(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Loads (and transforms) all the samples at once with a single slice, instead of going row by row"""
+        return self.maybe_transform(self.data[self.idx]), self.labels
+
+    def indices_for_classes(self, classes: Iterable[int]) -> np.ndarray:
+        return np.nonzero(np.isin(self.labels, list(classes)))[0]
+
+    def subset_by_classes(self, classes: Iterable[int]) -> "ArrayDataset":
+        return self.get_subset(self.indices_for_classes(classes))
+
+    def filter_out_classes(self, classes_to_keep: Iterable[int]) -> "ArrayDataset":
+        return self.subset_by_classes(classes_to_keep)
+
+    def tolist(self) -> List[Tuple[np.ndarray, int]]:
+        return [xy for xy in self]
+
+    def get_subset(self, idx) -> "ArrayDataset":
+        return ArrayDataset(self.data, self.all_labels, self.batch_transform,
+                            self.idx[np.asarray(idx, dtype=int)], collate_fn=self.collate_fn)
+
+
+class SharedImageCache:
+    """
+    Cache of decoded (and resized) uint8 images, kept in shared memory with a bitmap of filled slots.
+    Since the storage is shared, it is filled and read by all the dataloader workers and by all the dataloaders,
+    so each image is decoded at most once per process tree.
+    Concurrent fills of the same slot write the same bytes, so we do not need any locking.
+    """
+    def __init__(self, num_imgs: int, img_shape: Tuple[int, int, int]):
+        self.imgs = torch.empty(num_imgs, *img_shape, dtype=torch.uint8).share_memory_()
+        self.is_filled = torch.zeros(num_imgs, dtype=torch.bool).share_memory_()
+
+    def get(self, idx: int, load_fn: Callable[[], np.ndarray]) -> np.ndarray:
+        if not self.is_filled[idx]:
+            self.imgs[idx] = torch.from_numpy(load_fn())
+            self.is_filled[idx] = True
+
+        return self.imgs[idx].numpy()
+
+
 class ImageDataset(Dataset):
-    def __init__(self, img_paths: List[PathLike], labels: List[int], transform: Callable=None, in_memory: bool=False):
+    def __init__(self, img_paths: List[PathLike], labels: List[int], transform: Callable=None, in_memory: bool=False,
+                 target_shape: Tuple[int, int]=None, cache: SharedImageCache=None, cache_idx: List[int]=None,
+                 collate_fn: Callable=None):
         self.img_paths = img_paths
-        self.labels = labels
+        self.collate_fn = collate_fn # Should be used by dataloaders (e.g. to normalize raw images batch-wise)
+        self.labels = np.asarray(labels)
         self.transform = transform
         self.in_memory = in_memory
+        self.target_shape = target_shape
 
-        if self.in_memory:
+        if self.in_memory and not self.target_shape is None:
+            # Images have the same shape, so we can keep them in a shared cache (subsets share it too)
+            self.cache = SharedImageCache(len(labels), (target_shape[1], target_shape[0], 3)) if cache is None else cache
+            self.cache_idx = list(range(len(labels))) if cache_idx is None else cache_idx
+        elif self.in_memory:
             self.cached_imgs = [None for _ in range(len(labels))]
 
     def maybe_transform(self, x) -> np.ndarray:
@@ -24,7 +106,11 @@ class ImageDataset(Dataset):
             return self.transform(x)
 
     def load_image(self, idx):
-        if self.in_memory:
+        if self.in_memory and not self.target_shape is None:
+            img = self.cache.get(self.cache_idx[idx], lambda: load_img(self.img_paths[idx], self.target_shape))
+
+            return self.maybe_transform(img)
+        elif self.in_memory:
             if self.cached_imgs[idx] is None:
                 self.cached_imgs[idx] = self.maybe_transform(load_img(self.img_paths[idx]))
 
@@ -33,7 +119,7 @@ class ImageDataset(Dataset):
             return self.maybe_transform(load_img(self.img_paths[idx]))
 
     def __getitem__(self, idx) -> Tuple[np.ndarray, int]:
-        label = self.labels[idx]
+        label = int(self.labels[idx])
         img = self.load_image(idx)
 
         return img, label
@@ -41,24 +127,30 @@ class ImageDataset(Dataset):
     def __len__(self) -> int:
         return len(self.img_paths)
 
-    def filter_out_classes(self, classes_to_keep: Iterable[int]) -> "ImageDataset":
-        classes_to_keep = set(classes_to_keep)
-        idx_to_keep = [i for i, l in enumerate(self.labels) if l in classes_to_keep]
+    def indices_for_classes(self, classes: Iterable[int]) -> np.ndarray:
+        return np.nonzero(np.isin(self.labels, list(classes)))[0]
 
-        return ImageDataset(
-            [self.img_paths[i] for i in idx_to_keep],
-            [self.labels[i] for i in idx_to_keep],
-            self.transform,
-            self.in_memory
-        )
+    def subset_by_classes(self, classes: Iterable[int]) -> "ImageDataset":
+        return self.get_subset(self.indices_for_classes(classes))
+
+    def filter_out_classes(self, classes_to_keep: Iterable[int]) -> "ImageDataset":
+        return self.subset_by_classes(classes_to_keep)
 
     def tolist(self) -> "ImageDataset":
         return [xy for xy in self]
 
     def get_subset(self, idx) -> "ImageDataset":
+        has_shared_cache = self.in_memory and not self.target_shape is None
+
+        idx = np.asarray(idx, dtype=int)
+
         return ImageDataset(
             [self.img_paths[i] for i in idx],
-            [self.labels[i] for i in idx],
+            self.labels[idx],
             self.transform,
-            self.in_memory
+            self.in_memory,
+            self.target_shape,
+            cache=(self.cache if has_shared_cache else None),
+            cache_idx=([self.cache_idx[i] for i in idx] if has_shared_cache else None),
+            collate_fn=self.collate_fn,
         )
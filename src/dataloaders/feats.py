@@ -1,12 +1,58 @@
 import os
+import shutil
+from os import PathLike
 from typing import List, Tuple
 
 import numpy as np
 
+from src.dataloaders.dataset import ArrayDataset
 
-def load_dataset(data_dir: str, input_type: str, split: str) -> List[Tuple[np.ndarray, int]]:
-    file_name = f'{split}_{input_type}.npy'
-    print(f'Loading {file_name}')
-    data = np.load(os.path.join(data_dir, file_name), allow_pickle=True)
 
-    return data
+def load_dataset(data_dir: str, input_type: str, split: str) -> ArrayDataset:
+    """
+    Loads features, kept as a directory with separate (memory-mapped) feats and labels arrays.
+    Old pickled `{split}_{input_type}.npy` files are converted into this format on the first load.
+    """
+    feats_dir = os.path.join(data_dir, f'{split}_{input_type}')
+
+    if not os.path.isdir(feats_dir):
+        convert_pickled_feats(os.path.join(data_dir, f'{split}_{input_type}.npy'), feats_dir)
+
+    print(f'Loading {feats_dir}')
+
+    return load_feats(feats_dir)
+
+
+def load_feats(feats_dir: PathLike) -> ArrayDataset:
+    feats = np.load(os.path.join(feats_dir, 'feats.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(feats_dir, 'labels.npy'))
+
+    return ArrayDataset(feats, labels, to_float32)
+
+
+def convert_pickled_feats(pickled_file_path: PathLike, feats_dir: PathLike, dtype: np.dtype=np.float32):
+    """Converts a pickled array of (feat, label) pairs into the structured format"""
+    print(f'Converting {pickled_file_path} into {feats_dir}')
+    data = np.load(pickled_file_path, allow_pickle=True)
+    feats = np.stack([x for x, _ in data])
+    labels = np.array([y for _, y in data])
+
+    save_feats(feats_dir, feats, labels, dtype=dtype)
+
+
+def save_feats(feats_dir: PathLike, feats: np.ndarray, labels: np.ndarray, dtype: np.dtype=np.float32):
+    """Saves features in float32/float16 and labels in int64. The directory appears atomically"""
+    tmp_dir = f'{feats_dir}.{os.getpid()}.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    np.save(os.path.join(tmp_dir, 'feats.npy'), np.ascontiguousarray(feats, dtype=dtype))
+    np.save(os.path.join(tmp_dir, 'labels.npy'), np.asarray(labels, dtype=np.int64))
+
+    try:
+        os.rename(tmp_dir, feats_dir)
+    except OSError:
+        # Someone else has already converted the features
+        shutil.rmtree(tmp_dir)
+
+
+def to_float32(feats: np.ndarray) -> np.ndarray:
+    return np.asarray(feats, dtype=np.float32)
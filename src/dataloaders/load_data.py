@@ -16,24 +16,24 @@ SIMPLE_LOADERS = {
 
 def load_data(config: Config, img_target_shape: Tuple[int, int]=None) -> Tuple[ImageDataset, ImageDataset, np.ndarray]:
     if config.name == 'CUB':
-        ds_train = cub.load_dataset(config.dir, split='train', target_shape=img_target_shape, in_memory=config.get('in_memory', False))
-        ds_test = cub.load_dataset(config.dir, split='test', target_shape=img_target_shape, in_memory=config.get('in_memory', False))
+        ds_train = cub.load_dataset(config.dir, split='train', target_shape=img_target_shape, in_memory=config.get('in_memory', False), shards_dir=config.get('shards_dir'), normalize_in_collate=config.get('normalize_in_collate', False))
+        ds_test = cub.load_dataset(config.dir, split='test', target_shape=img_target_shape, in_memory=config.get('in_memory', False), shards_dir=config.get('shards_dir'), normalize_in_collate=config.get('normalize_in_collate', False))
         class_attributes = cub.load_class_attributes(config.dir).astype(np.float32)
     elif config.name == 'CUB_EMBEDDINGS':
         ds_train = feats.load_dataset(config.dir, config.input_type, split='train')
         ds_test = feats.load_dataset(config.dir, config.input_type, split='test')
         class_attributes = cub.load_class_attributes(config.dir).astype(np.float32)
     elif config.name == 'AWA':
-        ds_train = awa.load_dataset(config.dir, split='train', target_shape=img_target_shape)
-        ds_test = awa.load_dataset(config.dir, split='test', target_shape=img_target_shape)
+        ds_train = awa.load_dataset(config.dir, split='train', target_shape=img_target_shape, shards_dir=config.get('shards_dir'), normalize_in_collate=config.get('normalize_in_collate', False))
+        ds_test = awa.load_dataset(config.dir, split='test', target_shape=img_target_shape, shards_dir=config.get('shards_dir'), normalize_in_collate=config.get('normalize_in_collate', False))
         class_attributes = awa.load_class_attributes(config.dir).astype(np.float32)
     elif config.name == 'SUN':
-        ds_train = sun.load_dataset(config.dir, split='train', target_shape=img_target_shape)
-        ds_test = sun.load_dataset(config.dir, split='val', target_shape=img_target_shape)
+        ds_train = sun.load_dataset(config.dir, split='train', target_shape=img_target_shape, in_memory=config.get('in_memory', False), shards_dir=config.get('shards_dir'), normalize_in_collate=config.get('normalize_in_collate', False))
+        ds_test = sun.load_dataset(config.dir, split='val', target_shape=img_target_shape, in_memory=config.get('in_memory', False), shards_dir=config.get('shards_dir'), normalize_in_collate=config.get('normalize_in_collate', False))
         class_attributes = sun.load_class_attributes(config.dir).astype(np.float32)
     elif config.name == 'TinyImageNet':
-        ds_train = tiny_imagenet.load_dataset(config.dir, split='train', target_shape=img_target_shape)
-        ds_test = tiny_imagenet.load_dataset(config.dir, split='val', target_shape=img_target_shape)
+        ds_train = tiny_imagenet.load_dataset(config.dir, split='train', target_shape=img_target_shape, in_memory=config.get('in_memory', False), shards_dir=config.get('shards_dir'))
+        ds_test = tiny_imagenet.load_dataset(config.dir, split='val', target_shape=img_target_shape, in_memory=config.get('in_memory', False), shards_dir=config.get('shards_dir'))
         class_attributes = None
     elif config.name in SIMPLE_LOADERS.keys():
         ds_train = SIMPLE_LOADERS[config.name](config.dir, split='train')
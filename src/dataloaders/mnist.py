@@ -4,11 +4,16 @@ from typing import Tuple
 import numpy as np
 from torchvision.datasets import MNIST
 
-from src.dataloaders.utils import shuffle_dataset
+from src.dataloaders.dataset import ArrayDataset
 
-def load_dataset(data_dir: os.PathLike, split: str):
+def load_dataset(data_dir: os.PathLike, split: str) -> ArrayDataset:
     ds = MNIST(data_dir, train=(split == 'train'))
-    imgs = [(x.numpy() / 127.5 - 1).astype(np.float32).reshape(-1) for x in ds.data]
-    ds = list(zip(*shuffle_dataset(imgs, ds.targets)))
+    # We keep the images as a single uint8 array and normalize them batch-wise
+    ds = ArrayDataset(ds.data.numpy(), ds.targets.numpy().astype(np.int64), normalize_imgs)
+    ds = ds.get_subset(np.random.permutation(len(ds)))
 
     return ds
+
+
+def normalize_imgs(imgs: np.ndarray) -> np.ndarray:
+    return (imgs / 127.5 - 1).astype(np.float32).reshape(len(imgs), -1)
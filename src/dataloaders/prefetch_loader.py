@@ -0,0 +1,82 @@
+from collections import deque
+from contextlib import nullcontext
+from typing import Iterator, Tuple, Any
+
+import torch
+from torch import Tensor
+from torch.utils.data import DataLoader
+
+
+class PrefetchLoader:
+    """
+    Wraps a dataloader, which yields batches of (pinned) CPU tensors, and moves the next `num_prefetch`
+    batches to the device ahead of time with non-blocking copies on a separate CUDA stream.
+    This way, host-to-device transfers overlap with the current training step.
+    Each copy records its own CUDA event, so a yielded batch waits only for itself and not for the batches behind it.
+
+    If a profiler is given, waiting for the dataloader is timed as the `data` phase,
+    and issuing/waiting for the copies as the `h2d` one (use `synchronize_cuda` to time the copies themselves).
+    """
+    def __init__(self, dataloader: DataLoader, device: str, num_prefetch: int=2, profiler: "Profiler"=None):
+        self.dataloader = dataloader
+        self.dataset = dataloader.dataset
+        self.batch_size = dataloader.batch_size
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.profiler = profiler
+        self.use_cuda_stream = self.device.type == 'cuda'
+
+    def with_profiler(self, profiler: "Profiler") -> "PrefetchLoader":
+        """Returns the same loader, but profiled (so we profile only the training loops and not the evaluation ones)"""
+        return PrefetchLoader(self.dataloader, self.device, self.num_prefetch, profiler)
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
+
+    def __iter__(self) -> Iterator[Tuple[Any, ...]]:
+        stream = torch.cuda.Stream(self.device) if self.use_cuda_stream else None
+        batches = self.dataloader if self.profiler is None else self.profiler.iterate(self.dataloader, 'data')
+        queue = deque()
+
+        for batch in batches:
+            with self.phase('h2d'):
+                queue.append(self.to_device(batch, stream))
+
+            if len(queue) > self.num_prefetch:
+                with self.phase('h2d'):
+                    batch = self.wait(*queue.popleft())
+                yield batch
+
+        while len(queue) > 0:
+            with self.phase('h2d'):
+                batch = self.wait(*queue.popleft())
+            yield batch
+
+    def phase(self, name: str):
+        return nullcontext() if self.profiler is None else self.profiler.phase(name)
+
+    def to_device(self, batch: Tuple[Any, ...], stream: "torch.cuda.Stream") -> Tuple[Tuple[Any, ...], "torch.cuda.Event"]:
+        """Issues the batch copy and returns the batch together with the event, which marks the copy end"""
+        if stream is None:
+            return tuple(v.to(self.device) if isinstance(v, Tensor) else v for v in batch), None
+
+        with torch.cuda.stream(stream):
+            batch = tuple(v.to(self.device, non_blocking=True) if isinstance(v, Tensor) else v for v in batch)
+            event = torch.cuda.Event()
+            event.record(stream)
+
+        return batch, event
+
+    def wait(self, batch: Tuple[Any, ...], event: "torch.cuda.Event") -> Tuple[Any, ...]:
+        """Makes the current stream wait for the batch copy (and tells the allocator that the batch is used there)"""
+        if event is None:
+            return batch
+
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(event)
+
+        for v in batch:
+            if isinstance(v, Tensor):
+                v.record_stream(current_stream)
+
+        return batch
@@ -5,8 +5,7 @@ from typing import List, Tuple, Callable
 import numpy as np
 from torch.utils.data import Dataset
 
-from src.dataloaders.utils import read_column, shuffle_dataset, create_default_transform
-from src.dataloaders.dataset import ImageDataset
+from src.dataloaders.utils import read_column, shuffle_dataset, build_image_dataset
 from src.utils.constants import DEBUG
 
 
@@ -14,7 +13,9 @@ def load_dataset(
         data_dir: PathLike,
         split: str='train',
         target_shape: Tuple[int, int]=None,
-        in_memory: bool=False) -> List[Tuple[np.ndarray, int]]:
+        in_memory: bool=False,
+        shards_dir: PathLike=None,
+        normalize_in_collate: bool=False) -> List[Tuple[np.ndarray, int]]:
 
     idx = np.load(os.path.join(data_dir, f'{split}_idx.npy'))
     img_paths = np.load(os.path.join(data_dir, 'image_files.npy'))
@@ -32,7 +33,8 @@ def load_dataset(
     img_paths = [os.path.join(data_dir, 'images', p) for p in img_paths]
     labels = labels.tolist()
 
-    return ImageDataset(img_paths, labels, create_default_transform(target_shape), in_memory=in_memory)
+    return build_image_dataset(img_paths, labels, 'SUN', split, target_shape, in_memory=in_memory,
+                               shards_dir=shards_dir, normalize_in_collate=normalize_in_collate)
 
 
 def load_class_attributes(data_dir: os.PathLike) -> np.ndarray:
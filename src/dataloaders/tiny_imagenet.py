@@ -1,23 +1,45 @@
 import os
 import random
 from os import PathLike
-from typing import List, Tuple
+from typing import List, Tuple, Callable
 
+import cv2
 import numpy as np
 
-from src.dataloaders.utils import shuffle_dataset, load_imgs, load_imgs_from_folder, preprocess_imgs, read_column
+from src.dataloaders.utils import read_column, create_default_transform, load_image_shard, normalize_imgs
+from src.dataloaders.dataset import ImageDataset, ArrayDataset
 
 DEBUG = False
 # DEBUG = True
+IMG_SHAPE = (64, 64) # All TinyImageNet images have the same size
 
 def load_dataset(
         data_dir: PathLike,
         split: str='train',
         preprocess: bool=False,
-        target_shape: Tuple[int, int]=None) -> List[Tuple[np.ndarray, int]]:
+        target_shape: Tuple[int, int]=None,
+        in_memory: bool=False,
+        shards_dir: PathLike=None) -> ImageDataset:
 
     assert split in ['train', 'val', 'test'], f"Unknown dataset split: {split}"
 
+    target_shape = IMG_SHAPE if target_shape is None else target_shape
+    img_paths, labels = load_dataset_paths(data_dir, split)
+
+    if not shards_dir is None:
+        imgs, labels = load_image_shard(shards_dir, 'TinyImageNet', split, img_paths, labels, target_shape)
+        dataset = ArrayDataset(imgs, labels, normalize_imgs if preprocess else None)
+    else:
+        dataset = ImageDataset(img_paths, labels, create_transform(target_shape, preprocess),
+                               in_memory=in_memory, target_shape=target_shape)
+
+    # Shuffling is just an index permutation, images are loaded lazily
+    if split == 'train': dataset = dataset.get_subset(np.random.permutation(len(dataset)))
+
+    return dataset
+
+
+def load_dataset_paths(data_dir: PathLike, split: str) -> Tuple[List[PathLike], List[int]]:
     with open(f'{data_dir}/wnids.txt', 'r') as f:
         class_names = f.read().splitlines()
         cls2idx = {c: i for i, c in enumerate(class_names)}
@@ -25,15 +47,14 @@ def load_dataset(
     if split == 'train':
         classes_dir = f'{data_dir}/train'
         classes = [d for d in os.listdir(classes_dir) if d.startswith('n')]
-        classes_dirs = [f'{classes_dir}/{c}/images' for c in classes]
+        classes_dirs = [f'{classes_dir}/{c}/images' for c in sorted(classes)]
         classes_dirs = [d for d in classes_dirs if os.path.isdir(d)]
-        all_imgs_paths = [f'{d}/{f}' for d in classes_dirs for f in os.listdir(d) if f.endswith('.JPEG')]
+        all_imgs_paths = [f'{d}/{f}' for d in classes_dirs for f in sorted(os.listdir(d)) if f.endswith('.JPEG')]
         assert len(all_imgs_paths) == 200 * 500
 
         if DEBUG:
-            all_imgs_paths = [f'{d}/{f}' for d in classes_dirs for f in os.listdir(d)[:2] if f.endswith('.JPEG')]
+            all_imgs_paths = [f'{d}/{f}' for d in classes_dirs for f in sorted(os.listdir(d))[:2] if f.endswith('.JPEG')]
 
-        imgs = load_imgs(all_imgs_paths, target_shape)
         labels = [cls2idx[os.path.basename(p)[:9]] for p in all_imgs_paths]
     elif split == 'val':
         imgs_dir = f'{data_dir}/val/images'
@@ -47,12 +68,16 @@ def load_dataset(
             img_names = img_names[:200]
             class_names = class_names[:200]
 
-        imgs = load_imgs_from_folder(imgs_dir, img_names, target_shape)
+        all_imgs_paths = [os.path.join(imgs_dir, p) for p in img_names]
         labels = [cls2idx[l] for l in class_names]
     else:
         raise NotImplementedError('We do not have labels for test split')
 
-    if split == 'train': imgs, labels = shuffle_dataset(imgs, labels)
-    if preprocess: imgs = preprocess_imgs(imgs)
+    return all_imgs_paths, labels
 
-    return list(zip(imgs, labels))
+
+def create_transform(target_shape: Tuple[int, int], preprocess: bool) -> Callable:
+    if preprocess:
+        return create_default_transform(target_shape)
+    else:
+        return lambda img: cv2.resize(img, target_shape)
@@ -1,21 +1,29 @@
 import os
+import json
+import hashlib
+import inspect
+import warnings
+import functools
 from os import PathLike
-from typing import List, Tuple, Any, Callable
+from typing import List, Tuple, Any, Callable, Union, Dict
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import torch
 import torch.nn as nn
+from torch import Tensor
 from torch.utils.data import DataLoader
 import numpy as np
 from tqdm import tqdm
 from torchvision import transforms
 from firelab.utils.training_utils import get_module_device
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Subset
 import torchvision.transforms.functional as TVF
 
 from src.models.classifier import ResnetEmbedder
 from src.models.layers import ResNetConvEmbedder
 from src.utils.constants import IMAGENET_MEAN, IMAGENET_STD
+from src.utils.training_utils import hash_model_state
 
 
 def read_column(filename: PathLike, column_idx: int, sep: str=' ') -> List[str]:
@@ -29,7 +37,7 @@ def shuffle_dataset(imgs: List[Any], labels: List[int]) -> Tuple[List[Any], List
     assert len(imgs) == len(labels)
 
     shuffling = np.random.permutation(len(imgs))
-    imgs = [imgs[i] for i in shuffling]
+    imgs = imgs[shuffling] if isinstance(imgs, np.ndarray) else [imgs[i] for i in shuffling]
     labels = [labels[i] for i in shuffling]
 
     return imgs, labels
@@ -41,8 +49,30 @@ def load_imgs_from_folder(image_folder: PathLike, img_paths: List[PathLike], *ar
     return load_imgs(full_img_paths, *args, **kwargs)
 
 
-def load_imgs(img_paths: List[PathLike], target_shape=None) -> List[np.ndarray]:
-    return [load_img(p, target_shape) for p in tqdm(img_paths, desc='[Loading dataset]')]
+def load_imgs(img_paths: List[PathLike], target_shape=None, num_threads: int=None) -> Union[np.ndarray, List[np.ndarray]]:
+    """
+    Decodes the images in parallel threads (cv2 releases the GIL).
+    When the target shape is given, images are written into a preallocated uint8 array [N, H, W, 3]
+    """
+    if target_shape is None:
+        with ThreadPoolExecutor(num_threads or os.cpu_count()) as pool:
+            return list(tqdm(pool.map(load_img, img_paths), total=len(img_paths), desc='[Loading dataset]'))
+
+    imgs = np.empty((len(img_paths), target_shape[1], target_shape[0], 3), dtype=np.uint8)
+    load_imgs_into(imgs, img_paths, target_shape, num_threads)
+
+    return imgs
+
+
+def load_imgs_into(imgs: np.ndarray, img_paths: List[PathLike], target_shape: Tuple[int, int],
+                   num_threads: int=None, desc: str='[Loading dataset]'):
+    """Decodes the images in parallel threads right into the given (preallocated or memory-mapped) array"""
+    def load(i: int):
+        imgs[i] = load_img(img_paths[i], target_shape)
+
+    with ThreadPoolExecutor(num_threads or os.cpu_count()) as pool:
+        for _ in tqdm(pool.map(load, range(len(img_paths))), total=len(img_paths), desc=desc):
+            pass
 
 
 def load_img(img_path: PathLike, target_shape: Tuple[int, int]=None, preprocess: bool=False):
@@ -58,7 +88,45 @@ def load_img(img_path: PathLike, target_shape: Tuple[int, int]=None, preprocess:
     return img
 
 
-def preprocess_imgs(imgs: List[np.ndarray]) -> List[np.ndarray]:
+def load_image_shard(shards_dir: PathLike, dataset_name: str, split: str, img_paths: List[PathLike],
+                     labels: List[int], target_shape: Tuple[int, int]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Loads a shard of resized uint8 images as a memory-mapped array (together with the labels).
+    The shard is built on the first call and is keyed by the dataset, its split, the target shape
+    and the list of images (so DEBUG subsets do not clash with the full datasets).
+    """
+    assert not target_shape is None, "Images should be resized to the same shape to be kept in a shard"
+
+    paths_hash = hashlib.sha1('\n'.join(str(p) for p in img_paths).encode()).hexdigest()[:10]
+    path = os.path.join(shards_dir, f'{dataset_name}-{split}-{target_shape[0]}x{target_shape[1]}-{paths_hash}')
+
+    # Labels are written last, so their presence means the shard is complete
+    if not os.path.exists(f'{path}.labels.npy'):
+        build_image_shard(path, img_paths, labels, target_shape)
+
+    return np.load(f'{path}.imgs.npy', mmap_mode='r'), np.load(f'{path}.labels.npy')
+
+
+def build_image_shard(path: PathLike, img_paths: List[PathLike], labels: List[int], target_shape: Tuple[int, int]):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_suffix = f'{os.getpid()}.tmp.npy'
+    # cv2 takes the shape as (width, height)
+    imgs = np.lib.format.open_memmap(f'{path}.imgs.{tmp_suffix}', mode='w+', dtype=np.uint8,
+                                     shape=(len(img_paths), target_shape[1], target_shape[0], 3))
+
+    load_imgs_into(imgs, img_paths, target_shape, desc='[Building images shard]')
+    imgs.flush()
+    del imgs
+
+    os.replace(f'{path}.imgs.{tmp_suffix}', f'{path}.imgs.npy')
+    np.save(f'{path}.labels.{tmp_suffix}', np.array(labels, dtype=np.int64))
+    os.replace(f'{path}.labels.{tmp_suffix}', f'{path}.labels.npy')
+
+
+def preprocess_imgs(imgs: Union[np.ndarray, List[np.ndarray]]) -> Union[np.ndarray, List[np.ndarray]]:
+    if isinstance(imgs, np.ndarray):
+        return normalize_imgs(imgs)
+
     return [normalize_img(img).transpose(2, 0, 1) for img in tqdm(imgs, desc='[Preprocessing]')]
 
 
@@ -74,6 +142,20 @@ def normalize_img(img: np.ndarray) -> np.ndarray:
     return img_normalized.astype(np.float32)
 
 
+def normalize_imgs(imgs: np.ndarray) -> np.ndarray:
+    """
+    Batched version of `normalize_img` + transposition: [N, H, W, 3] uint8 => [N, 3, H, W] float32
+    """
+    assert imgs.dtype == np.uint8, f"Wrong images type: {imgs.dtype}"
+    assert imgs.ndim == 4 and imgs.shape[3] == 3, f"Wrong images shape: {imgs.shape}"
+
+    mean = (IMAGENET_MEAN * 255).astype(np.float32)
+    std = (IMAGENET_STD * 255).astype(np.float32)
+    imgs_normalized = (imgs.astype(np.float32) - mean) / std
+
+    return np.ascontiguousarray(imgs_normalized.transpose(0, 3, 1, 2))
+
+
 def default_transform(img: np.ndarray, target_shape: Tuple[int]=None) -> np.ndarray:
     if target_shape is None:
         result = img
@@ -90,6 +172,69 @@ def create_default_transform(target_shape: Tuple[int]) -> np.ndarray:
     return lambda x: default_transform(x, target_shape)
 
 
+def create_resize_transform(target_shape: Tuple[int]) -> Callable:
+    return lambda x: x if target_shape is None else cv2.resize(x, target_shape)
+
+
+def collate_normalized_imgs(batch: List[Tuple[np.ndarray, int]]) -> Tuple[Tensor, Tensor]:
+    """
+    Collates raw uint8 [H, W, 3] images and normalizes the whole batch at once.
+    This way, dataloader workers send uint8 images, which is 4 times less data than float32 ones
+    """
+    imgs, labels = zip(*batch)
+
+    return torch.from_numpy(normalize_imgs(np.stack(imgs))), torch.tensor(labels)
+
+
+def collate_to_tensors(batch: List[Tuple[np.ndarray, int]]) -> Tuple[Tensor, Tensor]:
+    """Stacks the samples into a single tensor (done in dataloader workers)"""
+    xs, labels = zip(*batch)
+
+    return torch.as_tensor(np.stack(xs)), torch.tensor(labels)
+
+
+def get_collate_fn(dataset: Dataset, default_collate_fn: Callable=None) -> Callable:
+    """Datasets which yield raw uint8 images keep a collate function, which does the normalization"""
+    while isinstance(dataset, Subset):
+        dataset = dataset.dataset
+
+    collate_fn = getattr(dataset, 'collate_fn', None)
+
+    return default_collate_fn if collate_fn is None else collate_fn
+
+
+def build_image_dataset(
+    img_paths: List[PathLike],
+    labels: List[int],
+    dataset_name: str,
+    split: str,
+    target_shape: Tuple[int, int]=None,
+    in_memory: bool=False,
+    shards_dir: PathLike=None,
+    normalize_in_collate: bool=False) -> Dataset:
+    """
+    Builds an image dataset: over a memory-mapped shard of resized images if `shards_dir` is given
+    and over the image files otherwise. With `normalize_in_collate`, the dataset yields raw uint8 images
+    and normalizes them batch-wise in its collate function.
+    """
+    # dataset module depends on this one, so we import it here
+    from src.dataloaders.dataset import ImageDataset, ArrayDataset
+
+    if not shards_dir is None:
+        imgs, labels = load_image_shard(shards_dir, dataset_name, split, img_paths, labels, target_shape)
+
+        if normalize_in_collate:
+            return ArrayDataset(imgs, labels, collate_fn=collate_normalized_imgs)
+        else:
+            return ArrayDataset(imgs, labels, normalize_imgs)
+
+    if normalize_in_collate:
+        return ImageDataset(img_paths, labels, create_resize_transform(target_shape), in_memory=in_memory,
+                            target_shape=target_shape, collate_fn=collate_normalized_imgs)
+    else:
+        return ImageDataset(img_paths, labels, create_default_transform(target_shape), in_memory=in_memory, target_shape=target_shape)
+
+
 def create_custom_dataset(paths_dataset, target_shape):
     def preprocessor(img):
         img = cv2.resize(img, target_shape)
@@ -122,15 +267,157 @@ def extract_features_for_dataset(
     dataset: List[Tuple[np.ndarray, int]],
     embedder: nn.Module,
     device: str='cpu',
-    batch_size: int=64) -> List[Tuple[np.ndarray, int]]:
+    batch_size: int=64,
+    cache_dir: PathLike=None,
+    dataset_key: str=None) -> "ArrayDataset":
+    """
+    Extracts features for the dataset. When `cache_dir` is given, the features are saved there
+    as memory-mappable arrays, keyed by the dataset identity (plus `dataset_key`, e.g. dataset name and split)
+    and the embedder weights, so the repeated runs skip the extraction.
+    """
+    # feats module depends on this one through ArrayDataset, so we import it here
+    from src.dataloaders.feats import load_feats, save_feats
+    from src.dataloaders.dataset import ArrayDataset
 
     embedder = embedder.eval()
     embedder = embedder.to(device)
+    cache_key = None if cache_dir is None else compute_features_cache_key(dataset, embedder, dataset_key)
+
+    if not cache_dir is None and cache_key is None:
+        warnings.warn('Cannot identify the dataset to cache its features, so we extract them anew. Provide `dataset_key`.')
+
+    if cache_key is None:
+        return ArrayDataset(*extract_features_and_labels(dataset, embedder, batch_size))
+
+    feats_dir = os.path.join(cache_dir, cache_key)
+
+    if not os.path.isdir(feats_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        save_feats(feats_dir, *extract_features_and_labels(dataset, embedder, batch_size))
+
+    return load_feats(feats_dir)
+
+
+def extract_features_and_labels(dataset: Dataset, embedder: nn.Module, batch_size: int=64) -> Tuple[np.ndarray, np.ndarray]:
+    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=4, collate_fn=get_collate_fn(dataset))
+    device = get_module_device(embedder)
+    feats, labels = [], []
+
+    # Features are always extracted in float32 (even inside a reduced-precision inference context),
+    # since they are cached and reused as the reference ones
+    with torch.no_grad(), torch.autocast(device_type=device.type, enabled=False):
+        for x, y in tqdm(dataloader, desc='[Extracting features]'):
+            feats.append(embedder(torch.as_tensor(np.array(x)).to(device)).float().cpu().numpy())
+            labels.append(np.array(y))
+
+    return np.concatenate(feats), np.concatenate(labels)
+
+
+def compute_features_cache_key(dataset: Dataset, embedder: nn.Module, dataset_key: str=None) -> str:
+    """
+    Content-based key for the features of the dataset. Returns None if we do not know how to identify the dataset.
+    If the dataset (e.g. its transform) cannot be described, `dataset_key` is trusted to identify it fully
+    """
+    try:
+        description = describe_dataset(dataset)
+    except ValueError as e:
+        warnings.warn(f'Cannot describe the dataset for its features cache key: {e}')
+        description = None
+
+    if description is None and dataset_key is None:
+        return None
+
+    hasher = hashlib.sha1()
+    hash_model_state(embedder, hasher)
+    hasher.update(json.dumps({'dataset': description, 'dataset_key': dataset_key}, sort_keys=True).encode())
+
+    return hasher.hexdigest()
+
+
+def describe_dataset(dataset: Dataset) -> Dict[str, Any]:
+    """
+    Describes the dataset contents (without loading them): images files, labels, shape and transforms.
+    Returns None for the datasets, which keep the data in memory (e.g. lists)
+    """
+    if isinstance(dataset, Subset):
+        parent = describe_dataset(dataset.dataset)
+
+        return None if parent is None else {'parent': parent, 'indices': [int(i) for i in dataset.indices]}
+    elif hasattr(dataset, 'img_paths'):
+        return {
+            'img_paths': [str(p) for p in dataset.img_paths],
+            'labels': np.asarray(dataset.labels).tolist(),
+            'target_shape': dataset.target_shape,
+            'transform': describe_transform(dataset.transform),
+            'collate_fn': describe_transform(dataset.collate_fn),
+        }
+    elif isinstance(getattr(dataset, 'data', None), np.memmap):
+        return {
+            'file': os.path.abspath(dataset.data.filename),
+            'idx': dataset.idx.tolist(),
+            'labels': dataset.labels.tolist(),
+            'transform': describe_transform(dataset.batch_transform),
+            'collate_fn': describe_transform(dataset.collate_fn),
+        }
+    else:
+        return None
+
+
+def describe_transform(transform: Callable) -> Any:
+    """
+    Fingerprint of a transform (to tell apart differently preprocessed datasets).
+    Functions are described by their name, bytecode, constants and closure values,
+    torchvision transforms by their class and attributes. Raises ValueError for anything else,
+    since a repr is often address-based or omits the parameters.
+    """
+    if transform is None:
+        return None
+    elif isinstance(transform, functools.partial):
+        return {
+            'func': describe_transform(transform.func),
+            'args': describe_value(list(transform.args)),
+            'kwargs': describe_value(transform.keywords),
+        }
+    elif inspect.isfunction(transform):
+        code = transform.__code__
+
+        return {
+            'name': f'{transform.__module__}.{transform.__qualname__}',
+            'code': hashlib.sha1(code.co_code).hexdigest(),
+            'consts': describe_value([c for c in code.co_consts if not inspect.iscode(c)]),
+            'names': list(code.co_names),
+            'closure': describe_value([c.cell_contents for c in (transform.__closure__ or [])]),
+        }
+    elif type(transform).__module__.startswith('torchvision.transforms'):
+        # Skipping nn.Module internals (torchvision transforms are modules since 0.8)
+        attrs = {k: v for k, v in vars(transform).items() if not k.startswith('_') and k != 'training'}
+
+        return {'class': type(transform).__qualname__, 'attrs': describe_value(attrs)}
+    else:
+        raise ValueError(f'Cannot describe transform {transform!r}')
+
+
+def describe_value(value: Any) -> Any:
+    """JSON-serializable description of a transform parameter (see `describe_transform`)"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    elif isinstance(value, (list, tuple)):
+        return [describe_value(v) for v in value]
+    elif isinstance(value, dict):
+        return {str(k): describe_value(v) for k, v in value.items()}
+    elif isinstance(value, (np.ndarray, Tensor)):
+        array = value.detach().cpu().numpy() if isinstance(value, Tensor) else value
+
+        return {'shape': list(array.shape), 'dtype': str(array.dtype), 'sha1': hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()}
+    elif callable(value):
+        return describe_transform(value)
+
+    description = repr(value)
 
-    imgs = [x for x, _ in dataset]
-    features = extract_features(imgs, embedder, batch_size=batch_size)
+    if ' at 0x' in description:
+        raise ValueError(f'Cannot describe value {description}')
 
-    return list(zip(features, [y for _, y in dataset]))
+    return description
 
 
 def extract_features(imgs: List[np.ndarray], embedder: nn.Module, batch_size: int=64, verbose: bool=True) -> List[np.ndarray]:
@@ -6,6 +6,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 from torchvision.models.resnet import resnet18, resnet34, resnet50
 from firelab.config import Config
 
@@ -218,16 +219,35 @@ class MILayer(nn.Module):
     A Multiplicative Interaction layer: f(x, z) = z'Wx + z'U + Vx + b
     The first part (z'Wx) is MI, the second part (z'U + Vx + b) is equivalent to concatenation-based approach
     Reference: https://openreview.net/forum?id=rylnK6VtDH
+
+    By default, z'Wx is computed with einsum, contracting x and z with the reshaped W one by one.
+    We choose the contraction order with the smallest intermediate, so unless x_dim is the smallest dimension
+    we never form [batch_size, x_dim, out_dim] per-sample weight matrices (which `impl="matmul"` does).
+    Note that any order still forms a per-sample intermediate of two of the three dims (e.g. [batch_size, out_dim, z_dim]),
+    which is kept for backward. With `chunk_size`, the outputs are computed in chunks of out_dim, which are
+    recomputed in backward, so at most one [batch_size, chunk_size, ...] intermediate is alive at a time.
+    With `rank`, W is factorized through a rank-sized projection of z, which reduces the number of parameters
+    from z_dim * x_dim * out_dim to rank * (z_dim + x_dim * out_dim) and the intermediates to [batch_size, out_dim, rank].
     """
-    def __init__(self, x_dim: int, z_dim: int, out_dim: int, combine_with_concat: bool=True):
+    def __init__(self, x_dim: int, z_dim: int, out_dim: int, combine_with_concat: bool=True,
+                 rank: int=None, impl: str='einsum', chunk_size: int=None):
         super().__init__()
 
+        assert impl in ('einsum', 'matmul'), f"Unknown MILayer implementation: {impl}"
+
         self.x_dim = x_dim
         self.z_dim = z_dim
         self.out_dim = out_dim
         self.combine_with_concat = combine_with_concat
+        self.rank = rank
+        self.impl = impl
+        self.chunk_size = chunk_size
 
-        self.mi_layer = nn.Linear(z_dim, out_dim * x_dim) # Let's keep the bias since it's soo cheap
+        if self.rank is None:
+            self.mi_layer = nn.Linear(z_dim, out_dim * x_dim) # Let's keep the bias since it's soo cheap
+        else:
+            self.context_proj = nn.Linear(z_dim, rank, bias=False)
+            self.mi_layer = nn.Linear(rank, out_dim * x_dim)
 
         if self.combine_with_concat:
             self.dense = nn.Linear(x_dim + z_dim, out_dim)
@@ -237,20 +257,72 @@ class MILayer(nn.Module):
         assert x.size(0) == z.size(0)
         assert x.size(1) == self.x_dim
         assert z.size(1) == self.z_dim
-        batch_size = x.size(0)
 
-        contextualized_transform = self.mi_layer(z) # [batch_size, out_dim * x_dim]
-        contextualized_transform = contextualized_transform.view(batch_size, self.x_dim, self.out_dim)
-        result = x.view(batch_size, 1, self.x_dim) @ contextualized_transform
-        result = result.squeeze(1)
+        context = z if self.rank is None else self.context_proj(z)
+
+        if self.impl == 'einsum':
+            result = self.compute_mi_einsum(x, context)
+        else:
+            result = self.compute_mi_matmul(x, context)
 
         if self.combine_with_concat:
-            result += self.dense(torch.cat([x, z], dim=1))
+            result = result + self.dense(torch.cat([x, z], dim=1))
 
         assert result.shape == (x.size(0), self.out_dim), f"Wrong shape: {result.shape}"
 
         return result
 
+    def compute_mi_matmul(self, x: Tensor, context: Tensor) -> Tensor:
+        batch_size = x.size(0)
+        contextualized_transform = self.mi_layer(context) # [batch_size, out_dim * x_dim]
+        contextualized_transform = contextualized_transform.view(batch_size, self.x_dim, self.out_dim)
+        result = x.view(batch_size, 1, self.x_dim) @ contextualized_transform
+
+        return result.squeeze(1)
+
+    def compute_mi_einsum(self, x: Tensor, context: Tensor) -> Tensor:
+        weight = self.mi_layer.weight.view(self.x_dim, self.out_dim, context.size(1))
+        bias = self.mi_layer.bias.view(self.x_dim, self.out_dim)
+
+        if self.chunk_size is None or self.chunk_size >= self.out_dim:
+            return contract_mi(x, context, weight, bias)
+
+        chunks = []
+
+        for start in range(0, self.out_dim, self.chunk_size):
+            weight_chunk = weight[:, start:start + self.chunk_size]
+            bias_chunk = bias[:, start:start + self.chunk_size]
+
+            if torch.is_grad_enabled():
+                chunks.append(checkpoint(contract_mi, x, context, weight_chunk, bias_chunk, use_reentrant=False))
+            else:
+                chunks.append(contract_mi(x, context, weight_chunk, bias_chunk))
+
+        return torch.cat(chunks, dim=1)
+
+
+def contract_mi(x: Tensor, context: Tensor, weight: Tensor, bias: Tensor) -> Tensor:
+    """
+    Computes x'W(context) + x'b for W of size [x_dim, out_dim, context_dim] and b of size [x_dim, out_dim]
+    in the contraction order with the smallest per-sample intermediate
+    """
+    x_dim, out_dim, context_dim = weight.shape
+    intermediate_sizes = {
+        'out_context': out_dim * context_dim,
+        'x_context': x_dim * context_dim,
+        'x_out': x_dim * out_dim,
+    }
+    order = min(intermediate_sizes, key=intermediate_sizes.get)
+
+    if order == 'out_context':
+        result = torch.einsum('bok,bk->bo', torch.einsum('bi,iok->bok', x, weight), context)
+    elif order == 'x_context':
+        result = torch.einsum('bik,iok->bo', x.unsqueeze(2) * context.unsqueeze(1), weight)
+    else:
+        result = torch.einsum('bi,bio->bo', x, torch.einsum('bk,iok->bio', context, weight))
+
+    return result + x @ bias
+
 
 class ConcatLayer(nn.Module):
     """
@@ -1,13 +1,17 @@
 import sys; sys.path.append('.')
 import argparse
-from typing import List, Dict, Any
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import List, Dict, Any, Callable
 
 import numpy as np
+import torch
 from firelab.config import Config
 from firelab.utils.training_utils import fix_random_seed
 
 from src.trainers.lll_trainer import LLLTrainer
-from src.utils.constants import DEBUG
+from src.utils.constants import DEBUG, NEG_INF
 from slurm.utils import generate_experiments_from_hpo_grid
 
 
@@ -30,35 +34,51 @@ def run_validation_sequence(args: argparse.Namespace, config: Config):
     experiments_vals = generate_experiments_from_hpo_grid(config.validation_sequence.hpo_grid)
     experiments_vals = [{p.replace('|', '.'): v for p, v in exp.items()} for exp in experiments_vals]
     configs = [config.overwrite({'hp': Config(hp)}) for hp in experiments_vals]
-    scores = []
+    val_configs = [c.overwrite(Config({
+        'experiments_dir': f'{config.experiments_dir}-val-seqs',
+        'lll_setup.num_tasks': c.validation_sequence.num_tasks,
+        'logging.save_train_logits': False,
+        'logging.print_accuracy_after_task': False,
+        'logging.print_unseen_accuracy': False,
+        'logging.print_forgetting': False,
+        'exp_name': compute_experiment_name(args, c.hp), # Candidates may run in parallel, so they need separate dirs
+        'no_saving': True,
+        'should_checkpoint': False,
+        'resume_from_checkpoints_dir': None, # Candidates should not resume from the final run's checkpoints
+    })) for c in configs]
+    metric = config.validation_sequence.metric
+    early_stopping_margin = config.validation_sequence.get('early_stopping_margin', -1)
+    num_workers = min(config.validation_sequence.get('num_workers', 1), len(configs))
+    scores = [None for _ in configs]
 
     print(f'Number of random experiments: {len(configs)}')
 
-    for i, c in enumerate(configs):
-        print('<==== Running HPs ====>')
-        print(experiments_vals[i])
-
-        c = c.overwrite(Config({
-            'experiments_dir': f'{config.experiments_dir}-val-seqs',
-            'lll_setup.num_tasks': c.validation_sequence.num_tasks,
-            'logging.save_train_logits': False,
-            'logging.print_accuracy_after_task': False,
-            'logging.print_unseen_accuracy': False,
-            'logging.print_forgetting': False,
-            'exp_name': compute_experiment_name(args, config.hp),
-            'no_saving': True,
-        }))
-        trainer = LLLTrainer(c)
-        trainer.start()
-
-        if config.validation_sequence.metric == 'harmonic_mean':
-            score = np.mean(trainer.compute_harmonic_mean_accuracy())
-        elif config.validation_sequence.metric == 'final_task_wise_acc':
-            score = np.mean(trainer.compute_final_tasks_performance())
-        else:
-            raise NotImplementedError('Unknown metric')
-
-        scores.append(score)
+    if num_workers <= 1:
+        best_partial_scores = {}
+        lock = threading.Lock()
+
+        for i in range(len(configs)):
+            print('<==== Running HPs ====>')
+            print(experiments_vals[i])
+
+            scores[i] = run_validation_candidate(val_configs[i], metric, early_stopping_margin, best_partial_scores, lock)
+    else:
+        # We use "spawn" since the parent process might have already initialized CUDA
+        mp_context = mp.get_context('spawn')
+        manager = mp_context.Manager()
+        best_partial_scores = manager.dict()
+        lock = manager.Lock()
+        num_threads = config.validation_sequence.get('num_threads_per_worker', 1)
+
+        with ProcessPoolExecutor(num_workers, mp_context=mp_context, initializer=torch.set_num_threads, initargs=(num_threads,)) as executor:
+            futures = {executor.submit(run_validation_candidate, c, metric, early_stopping_margin, best_partial_scores, lock): i for i, c in enumerate(val_configs)}
+
+            for future in as_completed(futures):
+                i = futures[future]
+                scores[i] = future.result()
+                print(f'Finished HPs {experiments_vals[i]} with score: {scores[i]: .04f}')
+
+        manager.shutdown()
 
     best_config = configs[np.argmax(scores)]
     print('Best found setup:', experiments_vals[np.argmax(scores)])
@@ -69,6 +89,43 @@ def run_validation_sequence(args: argparse.Namespace, config: Config):
     trainer.start()
 
 
+def run_validation_candidate(config: Config, metric: str, early_stopping_margin: float=-1,
+                             best_partial_scores: Dict[int, float]=None, lock: Any=None) -> float:
+    """
+    Trains a single validation sequence candidate and returns its score.
+    If `early_stopping_margin` is non-negative, the candidate is stopped as soon as
+    its partial score trails the best partial score (after the same number of tasks) by more than the margin.
+    """
+    fix_random_seed(config.random_seed, enable_cudnn_deterministic=True, disable_cudnn_benchmark=True)
+
+    trainer = LLLTrainer(config)
+
+    if early_stopping_margin >= 0:
+        trainer.after_task_done_callbacks.append(
+            create_early_stopping_callback(metric, early_stopping_margin, best_partial_scores, lock))
+
+    trainer.start()
+
+    return NEG_INF if trainer.should_stop else trainer.compute_validation_score(metric)
+
+
+def create_early_stopping_callback(metric: str, margin: float, best_partial_scores: Dict[int, float], lock: Any) -> Callable:
+    def callback(trainer: LLLTrainer):
+        score = trainer.compute_validation_score(metric, partial=True)
+
+        if np.isnan(score):
+            return
+
+        with lock:
+            best_score = max(best_partial_scores.get(trainer.num_tasks_learnt, NEG_INF), score)
+            best_partial_scores[trainer.num_tasks_learnt] = best_score
+
+        if score < best_score - margin:
+            trainer.should_stop = True
+
+    return callback
+
+
 def load_config(args: argparse.Namespace, config_cli_args: List[str]) -> Config:
     base_config = Config.load('configs/base.yml')
     curr_config = Config.load(f'configs/{args.config_name}.yml')
@@ -1,5 +1,4 @@
 from typing import Tuple
-import random
 
 import torch
 from torch import Tensor
@@ -8,20 +7,39 @@ import numpy as np
 from src.trainers.task_trainer import TaskTrainer
 from src.utils.training_utils import prune_logits
 from src.utils.constants import NEG_INF
-from src.utils.data_utils import construct_output_mask, flatten
+from src.utils.data_utils import construct_output_mask
 
 
 class AgemTaskTrainer(TaskTrainer):
     def _after_init_hook(self):
+        self.init_flat_grad()
+
+    def init_flat_grad(self):
+        """
+        Allocates a single flat buffer for the gradients and makes parameters' .grad be its views.
+        This way, the projection is done in-place without concatenating and re-slicing the gradients.
+        Note: we cannot use `optim.zero_grad()` anymore since it might set .grad to None and break the aliasing.
+        All the task trainers are kept alive, so we reuse the buffers of the previous one instead of allocating new ones.
+        """
+        params = [p for p in self.model.parameters() if p.requires_grad]
+        num_params = sum(p.numel() for p in params)
         prev_trainer = self.get_previous_trainer()
 
-        if self.task_idx == 0:
-            self.episodic_memory = []
-            self.episodic_memory_output_mask = []
-        elif prev_trainer != None:
-            prev_trainer = self.main_trainer.task_trainers[self.task_idx - 1]
-            self.episodic_memory = prev_trainer.episodic_memory
-            self.episodic_memory_output_mask = prev_trainer.episodic_memory_output_mask
+        if not prev_trainer is None and prev_trainer.flat_grad.numel() == num_params:
+            self.flat_grad, self.ref_grad = prev_trainer.flat_grad, prev_trainer.ref_grad
+            self.flat_grad.zero_()
+        else:
+            self.flat_grad = torch.zeros(num_params, device=params[0].device)
+            self.ref_grad = torch.zeros_like(self.flat_grad)
+
+        offset = 0
+
+        for p in params:
+            p.grad = self.flat_grad[offset:offset + p.numel()].view_as(p)
+            offset += p.numel()
+
+    def zero_grad(self):
+        self.flat_grad.zero_()
 
     def is_trainable(self) -> bool:
         if not super().is_trainable:
@@ -37,54 +55,43 @@ class AgemTaskTrainer(TaskTrainer):
         if self.task_idx - self.config.get('start_task', 0) > 0:
             assert len(self.episodic_memory) > 0
 
-            ref_grad = self.compute_ref_grad()
-            loss.backward()
-            grad = torch.cat([p.grad.data.view(-1) for p in self.model.parameters() if p.requires_grad])
-            grad = self.project_grad(grad, ref_grad)
+            with self.profiler.phase('ref_grad'):
+                self.compute_ref_grad()
 
-            self.optim.zero_grad()
-            self.set_grad(grad)
+            with self.profiler.phase('backward'):
+                loss.backward()
+
+            with self.profiler.phase('grad_projection'):
+                self.project_grad(self.flat_grad, self.ref_grad)
         else:
-            self.optim.zero_grad()
-            loss.backward()
+            self.zero_grad()
+
+            with self.profiler.phase('backward'):
+                loss.backward()
 
-        self.optim.step()
+        with self.profiler.phase('optim_step'):
+            self.optim.step()
 
     def compute_ref_grad(self):
+        """Computes the reference gradient on a memory batch and stores it into self.ref_grad"""
         num_samples_to_use = min(self.config.hp.mem_batch_size, len(self.episodic_memory))
-        batch_idx = random.sample(np.arange(len(self.episodic_memory)).tolist(), num_samples_to_use)
-        batch = [m for i, m in enumerate(self.episodic_memory) if i in batch_idx]
-        output_mask = np.array([m for i, m in enumerate(self.episodic_memory_output_mask) if i in batch_idx])
+        x, y, output_mask = self.episodic_memory.sample(num_samples_to_use, 'x', 'y', 'output_mask', replace=False)
+        x, y, output_mask = x.to(self.device_name), y.to(self.device_name), output_mask.to(self.device_name)
 
-        x = torch.from_numpy(np.array([x for x,_ in batch])).to(self.device_name)
-        y = torch.tensor([y for _, y in batch]).to(self.device_name)
+        self.zero_grad()
         logits = self.model(x)
-        pruned_logits = logits.masked_fill(torch.tensor(~output_mask).to(self.device_name), NEG_INF)
+        pruned_logits = logits.masked_fill(~output_mask, NEG_INF)
         loss = self.criterion(pruned_logits, y)
         loss.backward()
-        ref_grad = torch.cat([p.grad.data.view(-1) for p in self.model.parameters() if p.requires_grad])
-        self.optim.zero_grad()
-
-        return ref_grad
-
-    def project_grad(self, grad, ref_grad):
-        dot_product = torch.dot(grad, ref_grad)
-
-        if dot_product > 0:
-            return grad
-        else:
-            return grad - ref_grad * dot_product / ref_grad.pow(2).sum()
-
-    def set_grad(self, grad: Tensor):
-        """Takes gradient and sets it to parameters .grad"""
-        assert grad.dim() == 1
+        self.ref_grad.copy_(self.flat_grad)
+        self.zero_grad()
 
-        for param in self.model.parameters():
-            if not param.requires_grad: continue
-            param.grad.data = grad[:param.numel()].view(*param.shape).data
-            grad = grad[param.numel():]
+    def project_grad(self, grad: Tensor, ref_grad: Tensor):
+        """Projects the gradient in-place if it conflicts with the reference one"""
+        dot_product = torch.dot(grad, ref_grad).item()
 
-        assert len(grad) == 0, "Not all weights were used!"
+        if dot_product < 0:
+            grad.add_(ref_grad, alpha=-dot_product / torch.dot(ref_grad, ref_grad).item())
 
     def update_episodic_memory(self):
         """
@@ -95,16 +102,10 @@ class AgemTaskTrainer(TaskTrainer):
             - num_samples_per_class — max number of samples of each class to add
         """
         num_samples_per_class = self.config.hp.num_mem_samples_per_class
-        unique_labels = set([y for _, y in self.load_dataset(self.task_ds_train)])
-        groups = [[(x,y) for (x,y) in self.load_dataset(self.task_ds_train) if y == label] for label in unique_labels] # Slow but concise
-        num_samples_to_add = [min(len(g), num_samples_per_class) for g in groups]
-        task_memory = [random.sample(g, n) for g, n in zip(groups, num_samples_to_add)]
-        task_memory = flatten(task_memory)
+        xs, ys = self.load_memory_samples(num_samples_per_class)
         task_mask = construct_output_mask(self.main_trainer.class_splits[self.task_idx], self.config.lll_setup.num_classes)
-        task_mask = task_mask.reshape(1, -1).repeat(len(task_memory), axis=0)
+        task_mask = task_mask.reshape(1, -1).repeat(len(ys), axis=0)
 
-        assert len(task_memory) <= num_samples_per_class * len(groups)
-        assert len(task_mask) <= num_samples_per_class * len(groups)
+        assert len(ys) <= num_samples_per_class * len(self.classes)
 
-        self.episodic_memory.extend(task_memory)
-        self.episodic_memory_output_mask.extend([m for m in task_mask])
+        self.episodic_memory.extend(xs, ys, output_mask=task_mask)
@@ -9,5 +9,9 @@ class BasicTaskTrainer(TaskTrainer):
         self.model.train()
         loss = self.compute_loss(self.model, batch)
         self.optim.zero_grad()
-        loss.backward()
-        self.optim.step()
+
+        with self.profiler.phase('backward'):
+            loss.backward()
+
+        with self.profiler.phase('optim_step'):
+            self.optim.step()
@@ -1,10 +1,13 @@
+from typing import Dict, Any, Tuple
+
 import numpy as np
 import torch
 import torch.nn.functional as F
+from torch import Tensor
 
 from src.trainers.task_trainer import TaskTrainer
-from src.utils.data_utils import sample_instances_for_em
 from src.utils.training_utils import compute_accuracy, construct_optimizer, prune_logits
+from src.utils.training_utils import quantize_images, dequantize_images
 from src.models.upsampler import Upsampler
 
 
@@ -12,7 +15,7 @@ class DEMTaskTrainer(TaskTrainer):
     def init_models(self):
         self.model = self.main_trainer.model
 
-        if self.task_idx == 0:
+        if self.get_previous_trainer() is None:
             self.upsampler = Upsampler(self.config).to(self.device_name)
         else:
             self.upsampler = self.get_previous_trainer().upsampler
@@ -25,14 +28,21 @@ class DEMTaskTrainer(TaskTrainer):
 
         return construct_optimizer(parameters, self.config.hp.optim)
 
+    def get_state(self) -> Dict[str, Any]:
+        return {**super().get_state(), 'upsampler': self.upsampler.state_dict()}
+
+    def load_state(self, state: Dict[str, Any]):
+        super().load_state(state)
+        self.upsampler.load_state_dict(state['upsampler'])
+
     def train_on_batch(self, batch):
         self.model.train()
 
-        x = torch.from_numpy(np.array(batch[0])).to(self.device_name)
-        y = torch.from_numpy(np.array(batch[1])).to(self.device_name)
+        x, y = batch
 
-        logits = self.model(x)
-        pruned_logits = prune_logits(logits, self.output_mask)
+        with self.profiler.phase('forward'):
+            logits = self.model(x)
+            pruned_logits = prune_logits(logits, self.output_mask)
 
         cls_loss = F.cross_entropy(pruned_logits, y)
         cls_acc = compute_accuracy(pruned_logits, y)
@@ -59,34 +69,54 @@ class DEMTaskTrainer(TaskTrainer):
             self.writer.add_scalar('train/logits_matching_loss', logits_matching_loss.item(), self.num_iters_done)
 
         if self.task_idx > 0:
-            rehearsal_loss, rehearsal_acc = self.compute_rehearsal_loss()
+            with self.profiler.phase('rehearsal'):
+                rehearsal_loss, rehearsal_acc = self.compute_rehearsal_loss()
             total_loss += self.config.hp.memory.loss_coef * rehearsal_loss
 
             self.writer.add_scalar('train/rehearsal_loss', rehearsal_loss.item(), self.num_iters_done)
             self.writer.add_scalar('train/rehearsal_acc', rehearsal_acc.item(), self.num_iters_done)
 
         self.optim.zero_grad()
-        total_loss.backward()
-        self.optim.step()
+
+        with self.profiler.phase('backward'):
+            total_loss.backward()
+
+        with self.profiler.phase('optim_step'):
+            self.optim.step()
 
         self.writer.add_scalar('train/cls_loss', cls_loss.item(), self.num_iters_done)
         self.writer.add_scalar('train/cls_acc', cls_acc.item(), self.num_iters_done)
 
     def transform_em_sample(self, x, no_grad=False):
         assert x.ndim == 4
-        downsampled = F.interpolate(x, size=self.config.hp.memory.downsample_size)
 
+        return self.upsample(self.downsample(x), no_grad=no_grad)
+
+    def downsample(self, x: Tensor) -> Tensor:
+        return F.interpolate(x, size=self.config.hp.memory.downsample_size)
+
+    def upsample(self, x: Tensor, no_grad: bool=False) -> Tensor:
         if no_grad:
             with torch.no_grad():
-                upsampled = self.upsampler(downsampled)
+                return self.upsampler(x)
         else:
-            upsampled = self.upsampler(downsampled)
+            return self.upsampler(x)
+
+    def compress_em_samples(self, x: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """Downsamples the images and quantizes them into uint8 (with per-channel min and scale)"""
+        with torch.no_grad():
+            return quantize_images(self.downsample(x))
 
-        return upsampled
+    def sample_from_memory(self, batch_size: int) -> Tuple[Tensor, Tensor]:
+        """Samples low-resolution images from the memory and restores their original size"""
+        fields = self.episodic_memory.sample(batch_size, 'x', 'x_min', 'x_scale', 'y')
+        x_quantized, x_min, x_scale, y = [v.to(self.device_name) for v in fields]
+        x = self.upsample(dequantize_images(x_quantized, x_min, x_scale), no_grad=True)
+
+        return x, y
 
     def compute_rehearsal_loss(self):
         x, y = self.sample_from_memory(self.config.hp.memory.batch_size)
-        x = self.transform_em_sample(x, no_grad=True)
         pruned_logits = prune_logits(self.model(x), self.learned_classes_mask)
         cls_loss = F.cross_entropy(pruned_logits, y)
         cls_acc = compute_accuracy(pruned_logits, y)
@@ -94,9 +124,17 @@ class DEMTaskTrainer(TaskTrainer):
         return cls_loss, cls_acc
 
     def update_episodic_memory(self):
+        """
+        We keep the samples in the memory already downsampled and quantized,
+        so rehearsal only needs to dequantize and upsample them
+        """
         if self.config.hp.memory.num_samples_per_class == "all":
-            self.episodic_memory.extend(self.task_ds_train)
+            batches = self.create_dataloader(self.task_ds_train, shuffle=False)
         else:
-            for c in self.classes:
-                mem = sample_instances_for_em(self.task_ds_train, c, self.config.hp.memory.num_samples_per_class)
-                self.episodic_memory.extend(mem)
+            xs, ys = self.load_memory_samples(self.config.hp.memory.num_samples_per_class)
+            batch_size = self.config.get('inference_batch_size', self.config.hp.batch_size)
+            batches = ((xs[i:i + batch_size], ys[i:i + batch_size]) for i in range(0, len(xs), batch_size))
+
+        for x, y in batches:
+            x_quantized, x_min, x_scale = self.compress_em_samples(torch.as_tensor(x).to(self.device_name))
+            self.episodic_memory.extend(x_quantized, y, x_min=x_min, x_scale=x_scale)
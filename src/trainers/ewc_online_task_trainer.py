@@ -1,30 +1,58 @@
-from typing import Tuple
+from typing import Tuple, Dict, Any, List
 
 import torch
 import torch.nn.functional as F
 from torch import Tensor
 import numpy as np
 
-from src.utils.weights_importance import compute_diagonal_fisher
+from src.utils.weights_importance import compute_diagonal_fisher, compute_importances_cache_key
+from src.utils.weights_importance import load_cached_importances, save_cached_importances
 from src.utils.training_utils import prune_logits
 from src.trainers.task_trainer import TaskTrainer
 
 
 class EWCOnlineTaskTrainer(TaskTrainer):
+    importance_type = 'fisher'
+
     def _after_init_hook(self):
         prev_trainer = self.get_previous_trainer()
 
         if prev_trainer != None:
-            self.weights_prev = torch.cat([p.data.view(-1) for p in self.model.parameters()])
+            # Weights and importances are kept per parameter, so we never copy the whole parameters vector
+            self.weights_prev = [p.detach().clone() for p in self.model.parameters()]
 
-            curr_fisher = self.compute_importances(self.train_dataloader, prev_trainer.output_mask)
+            curr_fisher = self.compute_importances_cached(self.task_ds_train, prev_trainer.output_mask)
 
             if (self.task_idx - self.config.get('start_idx', 0)) == 1:
-                prev_fisher = torch.zeros_like(curr_fisher)
+                self.fisher = curr_fisher
             else:
-                prev_fisher = prev_trainer.fisher
+                self.fisher = [self.config.hp.fisher.gamma * f_prev + f_curr for f_prev, f_curr in zip(prev_trainer.fisher, curr_fisher)]
+
+            self.init_regularized_params()
+
+    def get_state(self) -> Dict[str, Any]:
+        state = super().get_state()
+
+        if hasattr(self, 'fisher'):
+            state['fisher'] = self.fisher
+            state['weights_prev'] = self.weights_prev
+
+        return state
 
-            self.fisher = self.config.hp.fisher.gamma * prev_fisher + curr_fisher
+    def load_state(self, state: Dict[str, Any]):
+        super().load_state(state)
+
+        if 'fisher' in state:
+            self.fisher = [f.to(self.device_name) for f in state['fisher']]
+            self.weights_prev = [w.to(self.device_name) for w in state['weights_prev']]
+            self.init_regularized_params()
+
+    def init_regularized_params(self):
+        """Chooses the parameters to regularize. Parameters with zero importance can be skipped"""
+        self.regularized_params_idx = list(range(len(self.fisher)))
+
+        if self.config.hp.fisher.get('skip_zero_importance', True):
+            self.regularized_params_idx = [i for i in self.regularized_params_idx if self.fisher[i].any()]
 
     def is_trainable(self) -> bool:
         return (self.task_idx == 0) or (self.get_previous_trainer() != None)
@@ -35,21 +63,56 @@ class EWCOnlineTaskTrainer(TaskTrainer):
         loss = self.compute_loss(self.model, batch)
 
         if self.task_idx > 0:
-            reg = self.compute_regularization()
-            loss += self.config.hp.fisher.loss_coef * reg
+            with self.profiler.phase('regularization'):
+                reg = self.compute_regularization()
+                loss += self.config.hp.fisher.loss_coef * reg
 
         self.optim.zero_grad()
-        loss.backward()
-        self.optim.step()
+
+        with self.profiler.phase('backward'):
+            loss.backward()
+
+        with self.profiler.phase('optim_step'):
+            self.optim.step()
 
     def get_weights_importances(self):
         return self.fisher
 
-    def compute_importances(self, dataloader, output_mask):
-        return compute_diagonal_fisher(self.model, dataloader, output_mask)
+    def compute_importances(self, dataset, output_mask) -> List[Tensor]:
+        return compute_diagonal_fisher(self.model, dataset, output_mask, **self.get_importance_estimation_kwargs())
+
+    def compute_importances_cached(self, dataset, output_mask) -> List[Tensor]:
+        """
+        Importances only depend on the model state and the task, so we can reuse them
+        between the runs (e.g. validation candidates or seeds which share the first tasks)
+        """
+        cache_dir = self.config.get('importance_cache_dir')
+
+        if cache_dir is None:
+            return self.compute_importances(dataset, output_mask)
+
+        key = compute_importances_cache_key(self.model, self.importance_type, self.classes, output_mask,
+            dataset=self.config.data.name, **self.get_importance_estimation_kwargs())
+        importances = load_cached_importances(cache_dir, key, device=self.device_name)
+
+        if importances is None:
+            importances = self.compute_importances(dataset, output_mask)
+            save_cached_importances(cache_dir, key, importances)
+
+        return importances
+
+    def get_importance_estimation_kwargs(self) -> Dict[str, Any]:
+        return {
+            'num_samples': self.config.hp.fisher.get('num_samples'),
+            'batch_size': self.config.hp.fisher.get('batch_size', self.config.hp.batch_size),
+            'per_sample_grads': self.config.hp.fisher.get('per_sample_grads', False),
+        }
 
     def compute_regularization(self) -> Tensor:
-        weights_curr = torch.cat([p.view(-1) for p in self.model.parameters()])
-        reg = torch.dot((weights_curr - self.weights_prev).pow(2), self.get_weights_importances())
+        params = list(self.model.parameters())
+        importances = self.get_weights_importances()
+        reg = sum(torch.dot((params[i] - self.weights_prev[i]).pow(2).view(-1), importances[i].view(-1)) \
+                  for i in self.regularized_params_idx)
 
         return reg
+
@@ -1,11 +1,14 @@
 import torch
 import numpy as np
 from torch import Tensor
+from torch.utils.data import DataLoader
 import torch.nn.functional as F
 
 from src.trainers.task_trainer import TaskTrainer
-from src.dataloaders.utils import extract_features
-from src.utils.data_utils import flatten
+from src.utils.data_utils import get_dataset_labels
+from src.dataloaders.utils import get_collate_fn
+from src.utils.herding import select_exemplars_by_herding
+from src.utils.episodic_memory import ExemplarStore
 from src.utils.training_utils import compute_accuracy, prune_logits
 
 
@@ -13,11 +16,11 @@ class iCarlTaskTrainer(TaskTrainer):
     def train_on_batch(self, batch):
         self.model.train()
 
-        x = torch.from_numpy(np.array(batch[0])).to(self.device_name)
-        y = torch.from_numpy(np.array(batch[1])).to(self.device_name)
+        x, y = batch
 
-        logits = self.model(x)
-        pruned_logits = prune_logits(logits, self.output_mask)
+        with self.profiler.phase('forward'):
+            logits = self.model(x)
+            pruned_logits = prune_logits(logits, self.output_mask)
 
         cls_loss = F.cross_entropy(pruned_logits, y)
         cls_acc = compute_accuracy(pruned_logits, y)
@@ -25,15 +28,20 @@ class iCarlTaskTrainer(TaskTrainer):
         total_loss = cls_loss
 
         if self.task_idx > 0:
-            rehearsal_loss, rehearsal_acc = self.compute_rehearsal_loss()
+            with self.profiler.phase('rehearsal'):
+                rehearsal_loss, rehearsal_acc = self.compute_rehearsal_loss()
             total_loss += self.config.hp.memory.loss_coef * rehearsal_loss
 
             self.writer.add_scalar('train/rehearsal_loss', rehearsal_loss.item(), self.num_iters_done)
             self.writer.add_scalar('train/rehearsal_acc', rehearsal_acc.item(), self.num_iters_done)
 
         self.optim.zero_grad()
-        total_loss.backward()
-        self.optim.step()
+
+        with self.profiler.phase('backward'):
+            total_loss.backward()
+
+        with self.profiler.phase('optim_step'):
+            self.optim.step()
 
         self.writer.add_scalar('train/cls_loss', cls_loss.item(), self.num_iters_done)
         self.writer.add_scalar('train/cls_acc', cls_acc.item(), self.num_iters_done)
@@ -52,39 +60,30 @@ class iCarlTaskTrainer(TaskTrainer):
         self.reduce_episodic_memory(num_samples_per_class)
         self.extend_episodic_memory(num_samples_per_class)
 
-    def reduce_episodic_memory(self, num_samples_per_class: int):
-        class_memories = [[(x, y) for x, y in self.episodic_memory if y == c] for c in self.learned_classes]
-        class_memories_reduced = [mem[:num_samples_per_class] for mem in class_memories]
+    def create_episodic_memory(self) -> ExemplarStore:
+        return ExemplarStore()
 
-        self.episodic_memory = flatten(class_memories_reduced)
+    def reduce_episodic_memory(self, num_samples_per_class: int):
+        # Exemplars are stored in the herding order, so we just keep the top ones
+        self.episodic_memory.truncate(num_samples_per_class)
 
     def extend_episodic_memory(self, num_samples_per_class: int):
-        for c in self.classes:
-            selected_idx = []
-            imgs = [x for (x, y) in self.load_dataset(self.task_ds_train) if y == c]
-            feats = torch.from_numpy(np.array(extract_features(imgs, self.model.embedder, 256, verbose=False)))
-            feats = feats / feats.norm(dim=1, keepdim=True)
-            prototype_gold = torch.from_numpy(np.array(feats).mean(axis=0))
-            prototype_gold = prototype_gold / prototype_gold.norm()
-            feats_selected = torch.empty(0, len(prototype_gold))
-            feats_remaining = feats
-
-            while len(selected_idx) < num_samples_per_class and len(feats_remaining) > 0:
-                assert len(selected_idx) == len(feats_selected)
-                assert (len(feats_selected) + len(feats_remaining)) == len(imgs)
-
-                best_idx = self.select_best_current_idx(feats_remaining, feats_selected, prototype_gold)
-                selected_idx.append(best_idx)
-                feats_selected = torch.cat([feats_selected, feats_remaining[best_idx].unsqueeze(0)])
-                feats_remaining = torch.cat([feats_remaining[:best_idx], feats_remaining[best_idx + 1:]])
-
-            self.episodic_memory.extend([(imgs[i], c) for i in selected_idx])
-
-    def select_best_current_idx(self, feats_remaining: Tensor, feats_selected: Tensor,
-                                prototype_gold: Tensor) -> int:
-        prototypes_next = (feats_selected.sum(dim=0, keepdim=True) + feats_remaining) / (len(feats_selected) + 1)
-        prototypes_next = prototypes_next / prototypes_next.norm(dim=1, keepdim=True)
-        distances = (prototypes_next - prototype_gold.unsqueeze(0)).pow(2).sum(dim=1)
-        best_idx = distances.argmax(dim=0)
-
-        return best_idx
+        """
+        Selects exemplars for all the task classes at once with herding
+        (on the embedder's device) and loads only the selected images
+        """
+        feats = self.compute_embeddings(self.task_ds_train)
+        labels = torch.from_numpy(get_dataset_labels(self.task_ds_train)).to(feats.device)
+        selected_idx = select_exemplars_by_herding(feats, labels, num_samples_per_class)
+        selected_idx = torch.cat([selected_idx[c] for c in self.classes if c in selected_idx]).cpu().numpy()
+
+        self.episodic_memory.extend(*self.load_samples(self.task_ds_train, idx=selected_idx))
+
+    @torch.no_grad()
+    def compute_embeddings(self, dataset) -> Tensor:
+        self.model.eval()
+        dataloader = DataLoader(dataset, batch_size=self.config.get('inference_batch_size', 256),
+                                collate_fn=get_collate_fn(dataset), num_workers=4)
+        feats = [self.model.embedder(torch.as_tensor(x).to(self.device_name)) for x, _ in dataloader]
+
+        return torch.cat(feats)
@@ -5,6 +5,7 @@ from torch.utils.data import DataLoader
 from src.utils.data_utils import construct_output_mask, flatten, remap_targets
 from src.utils.training_utils import prune_logits
 from src.trainers.task_trainer import TaskTrainer
+from src.dataloaders.utils import get_collate_fn, collate_to_tensors
 
 
 class JointTaskTrainer(TaskTrainer):
@@ -19,16 +20,21 @@ class JointTaskTrainer(TaskTrainer):
 
         self.joint_output_mask = construct_output_mask(seen_classes, self.config.lll_setup.num_classes)
         self.original_train_dataloader = self.train_dataloader
-        self.train_dataloader = DataLoader(self.task_ds_train, batch_size=self.config.hp.batch_size,
-                                           collate_fn=lambda b: list(zip(*b)), shuffle=True)
+        # Samples are taken from the main dataset, so we should collate them in the same way
+        collate_fn = get_collate_fn(self.main_trainer.ds_train, collate_to_tensors)
+        self.train_dataloader = self.create_dataloader(self.task_ds_train, shuffle=True, collate_fn=collate_fn)
 
     def train_on_batch(self, batch):
         self.model.train()
         loss = self.compute_loss(self.model, batch)
 
         self.optim.zero_grad()
-        loss.backward()
-        self.optim.step()
+
+        with self.profiler.phase('backward'):
+            loss.backward()
+
+        with self.profiler.phase('optim_step'):
+            self.optim.step()
 
     def compute_train_accuracy(self):
         return self.compute_accuracy(self.original_train_dataloader)
@@ -1,8 +1,9 @@
 import os
-from typing import List, Tuple
+import re
+from typing import List, Tuple, Dict, Any
 
 import torch
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import numpy as np
 from firelab.base_trainer import BaseTrainer
 from firelab.config import Config
@@ -24,8 +25,16 @@ from src.trainers.dem_task_trainer import DEMTaskTrainer
 from src.trainers.icarl_task_trainer import iCarlTaskTrainer
 
 from src.utils.data_utils import construct_output_mask, compute_class_centroids, flatten
-from src.utils.training_utils import normalize
-from src.dataloaders.utils import create_custom_dataset, extract_features_for_dataset
+from src.utils.profiling import Profiler, save_profiling_summary
+from src.utils.training_utils import (
+    normalize,
+    create_inference_context,
+    get_logits_storage_dtype,
+    compute_argmax_mismatch_rate,
+    get_rng_states,
+    set_rng_states
+)
+from src.dataloaders.utils import create_custom_dataset, extract_features_for_dataset, get_collate_fn
 from src.utils.metrics import (
     compute_acc_for_classes,
     compute_unseen_classes_acc_history,
@@ -57,6 +66,7 @@ class LLLTrainer(BaseTrainer):
 
         self.logger.info(f'Implementation method: {self.config.task_trainer}')
         self.logger.info(f'Using device: {self.device_name}')
+        create_inference_context(self.device_name, self.config.get('inference_precision', 'float32')) # Failing early on unsupported precisions
 
         self.episodic_memory = []
         self.episodic_memory_output_mask = []
@@ -66,6 +76,12 @@ class LLLTrainer(BaseTrainer):
         self.golden_logits_history = []
         self.train_accs = []
         self.test_accs = []
+        self.after_task_done_callbacks = []
+        self.should_stop = False
+        self.profiler = Profiler(
+            enabled=self.config.get('profiling.enabled', False),
+            trace=self.config.get('profiling.chrome_trace', False),
+            synchronize_cuda=self.config.get('profiling.synchronize_cuda', False))
 
         self.save_config()
 
@@ -112,11 +128,28 @@ class LLLTrainer(BaseTrainer):
         self.num_tasks_learnt = 0
         self.task_trainers = [] # TODO: this is memory-leaky :|
 
+        should_resume = self.config.get('should_checkpoint', False) or bool(self.config.get('resume_from_checkpoints_dir'))
+        checkpoint = self.load_latest_task_checkpoint() if should_resume else None
+        num_tasks_restored = 0 if checkpoint is None else checkpoint['task_idx'] + 1
+
         for task_idx in range(self.config.lll_setup.num_tasks):
             # print(f'Starting task #{task_idx}')
 
+            if task_idx < num_tasks_restored:
+                # Only the latest trainer is restored: the next one takes everything it needs from it
+                is_latest = task_idx == checkpoint['task_idx']
+                self.task_trainers.append(self.restore_from_task_checkpoint(checkpoint) if is_latest else None)
+                continue
+
             self.save_logits_history()
 
+            if self.num_tasks_learnt > 0:
+                self.run_after_task_done_callbacks()
+
+            if self.should_stop:
+                self.logger.info(f'Stopping the sequence after {self.num_tasks_learnt} tasks')
+                return
+
             task_trainer = TASK_TRAINERS[self.config.task_trainer](self, task_idx)
 
             self.task_trainers.append(task_trainer)
@@ -164,7 +197,16 @@ class LLLTrainer(BaseTrainer):
             values = self.compute_final_tasks_performance()
             print(f'Individual task accs (mean: {np.mean(values): .03f}): {", ".join([f"{a: 0.4f}" for a in values])}')
 
+    def run_after_task_done_callbacks(self):
+        """Callbacks are run when the logits for the latest learned task are already saved"""
+        for callback in self.after_task_done_callbacks:
+            callback(self)
+
     def save_logits_history(self):
+        with self.profiler.phase('logits_saving'):
+            self._save_logits_history()
+
+    def _save_logits_history(self):
         if self.config.get('logging.save_logits'):
             self.logits_history.append(self.run_inference(self.ds_test))
 
@@ -178,29 +220,36 @@ class LLLTrainer(BaseTrainer):
         if self.config.get('logging.save_train_logits'):
             self.train_logits_history.append(self.run_inference(self.ds_train))
 
-    def run_inference(self, dataset: List[Tuple[np.ndarray, int]], model_kwargs={}):
+    def run_inference(self, dataset: List[Tuple[np.ndarray, int]], model_kwargs={}, precision: str=None):
+        if precision is None:
+            precision = self.config.get('inference_precision', 'float32')
+
         self.model.eval()
 
-        dataloader = DataLoader(dataset, batch_size=self.config.get('inference_batch_size', self.config.hp.batch_size), num_workers=4)
+        dataloader = DataLoader(dataset, batch_size=self.config.get('inference_batch_size', self.config.hp.batch_size),
+                                collate_fn=get_collate_fn(dataset), num_workers=4)
+        logits_dtype = get_logits_storage_dtype(precision)
 
         with torch.no_grad():
             if self.config.hp.get('use_oracle_prototypes') or self.config.hp.get('use_oracle_softmax_mean'):
-                ds_train_feats = extract_features_for_dataset(self.ds_train, self.model.embedder, self.device_name, 256)
-                feats = extract_features_for_dataset(dataset, self.model.embedder, self.device_name, 256)
-                feats = normalize(torch.from_numpy(np.array([x for x, _ in feats])), self.config.hp.head.scale.value) # [ds_size, hid_dim]
+                # Features are extracted in float32 regardless of the precision: they are cached and numpy has no bfloat16
+                cache_dir = self.config.get('features_cache_dir')
+                ds_train_feats = extract_features_for_dataset(self.ds_train, self.model.embedder, self.device_name, 256, cache_dir=cache_dir)
+                feats = extract_features_for_dataset(dataset, self.model.embedder, self.device_name, 256, cache_dir=cache_dir)
+                feats = normalize(torch.from_numpy(feats.load_all()[0]), self.config.hp.head.scale.value) # [ds_size, hid_dim]
 
                 if self.config.hp.get('use_oracle_prototypes'):
                     prototypes_raw = compute_class_centroids(ds_train_feats, self.config.data.num_classes) # [num_classes, hid_dim]
                     prototypes = normalize(torch.from_numpy(prototypes_raw).float(), self.config.hp.head.scale.value) # [num_classes, hid_dim]
 
                     # Logits is the dot-product with the prototypes
-                    logits = (feats @ prototypes.t()).cpu().numpy() # [ds_size, num_classes]
+                    logits = (feats @ prototypes.t()).to(logits_dtype).cpu().numpy() # [ds_size, num_classes]
                 else:
                     max_num_protos_per_class = 25
                     ds_size = len(dataset)
                     n_classes = self.config.data.num_classes
 
-                    feats_train = normalize(torch.from_numpy(np.array([x for x, _ in ds_train_feats])), self.config.hp.head.scale.value) # [train_ds_size, hid_dim]
+                    feats_train = normalize(torch.from_numpy(ds_train_feats.load_all()[0]), self.config.hp.head.scale.value) # [train_ds_size, hid_dim]
                     classes_train = self.ds_train.labels
                     class_idx = [np.where(classes_train == c)[0][:max_num_protos_per_class] for c in range(n_classes)] # [n_classes, n_protos]
                     feats_train = torch.stack([feats_train[idx] for idx in class_idx]) # [n_classes, n_protos, hid_dim]
@@ -208,13 +257,34 @@ class LLLTrainer(BaseTrainer):
                     logits_mp = logits_mp.permute(2, 0, 1).view(ds_size, -1) # [ds_size, n_classes * n_protos]
                     probs_mp = logits_mp.softmax(dim=1)
                     logits = probs_mp.view(ds_size, n_classes, max_num_protos_per_class).sum(dim=2).log() # [ds_size, n_classes]
-                    logits = logits.cpu().numpy()
+                    logits = logits.to(logits_dtype).cpu().numpy()
             else:
-                logits = [self.model(torch.from_numpy(np.array(b)).to(self.device_name), **model_kwargs).cpu().numpy() for b, _ in dataloader]
-                logits = np.vstack(logits)
+                with create_inference_context(self.device_name, precision):
+                    logits = [self.model(torch.from_numpy(np.array(b)).to(self.device_name), **model_kwargs).to(logits_dtype).cpu().numpy() for b, _ in dataloader]
+                    logits = np.vstack(logits)
+
+        if precision != 'float32' and self.config.get('inference_agreement_check_size', 0) > 0:
+            self.check_inference_agreement(dataset, logits, precision, model_kwargs)
 
         return logits
 
+    def check_inference_agreement(self, dataset: List[Tuple[np.ndarray, int]], logits: np.ndarray, precision: str, model_kwargs={}) -> float:
+        """
+        Reruns inference in float32 on a random subset of the dataset
+        and reports how often the argmax predictions disagree with the reduced-precision ones
+        """
+        num_samples = min(self.config.inference_agreement_check_size, len(dataset))
+        idx = np.random.RandomState(self.config.random_seed).choice(len(dataset), size=num_samples, replace=False)
+        logits_ref = self.run_inference(Subset(dataset, idx), model_kwargs, precision='float32')
+        mismatch_rate = compute_argmax_mismatch_rate(logits[idx], logits_ref)
+
+        self.logger.info(f'Argmax mismatch rate ({precision} vs float32, {num_samples} samples): {mismatch_rate: .04f}')
+
+        if not self.config.get('no_saving'):
+            self.writer.add_scalar('inference/argmax_mismatch_rate', mismatch_rate, self.num_tasks_learnt)
+
+        return mismatch_rate
+
     def save_experiment_data(self):
         if self.config.get('no_saving'): return
         np.save(os.path.join(self.paths.custom_data_path, 'logits_history'), self.logits_history)
@@ -228,9 +298,102 @@ class LLLTrainer(BaseTrainer):
         if self.config.get('logging.save_final_model'):
             self.checkpoint('final-model')
 
+        if self.profiler.enabled:
+            self.save_profiling_data()
+
+    def save_profiling_data(self):
+        summary = {
+            'total': self.profiler.get_total_stats(),
+            'tasks': [(t.profiling_stats if not t is None else []) for t in self.task_trainers],
+        }
+        save_profiling_summary(os.path.join(self.paths.custom_data_path, 'profiling_summary.json'), summary)
+
+        if self.profiler.trace:
+            self.profiler.save_chrome_trace(os.path.join(self.paths.custom_data_path, 'chrome_trace.json'))
+
     def task_checkpoint(self, curr_task_idx: int):
+        """
+        Saves everything needed to resume the sequence after the given task.
+        The file is first written under a temporary name, so a preempted save never corrupts the latest checkpoint
+        """
         self.checkpoint(f'model-task-{curr_task_idx}')
 
+        if self.config.get('no_saving'): return
+
+        state = {
+            'task_idx': curr_task_idx,
+            'num_tasks': self.config.lll_setup.num_tasks,
+            'task_trainer_type': self.config.task_trainer,
+            'hp': self.config.hp.to_dict(),
+            'model': self.model.state_dict(),
+            'task_trainer': self.task_trainers[curr_task_idx].get_state(),
+            'logits_history': self.logits_history,
+            'train_logits_history': self.train_logits_history,
+            'train_accs': self.train_accs,
+            'test_accs': self.test_accs,
+            'rng_states': get_rng_states(),
+        }
+        path = os.path.join(self.paths.checkpoints_path, f'task-{curr_task_idx}.pt')
+        torch.save(state, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+
+        # Task checkpoints contain episodic memory and are heavy, so we keep only the latest one
+        prev_path = os.path.join(self.paths.checkpoints_path, f'task-{curr_task_idx - 1}.pt')
+        if os.path.exists(prev_path):
+            os.remove(prev_path)
+
+    def load_latest_task_checkpoint(self) -> Dict[str, Any]:
+        checkpoints_dir = self.config.get('resume_from_checkpoints_dir') or self.paths.checkpoints_path
+
+        if not os.path.isdir(checkpoints_dir):
+            return None
+
+        tasks_done = [re.fullmatch(r'task-(\d+)\.pt', f) for f in os.listdir(checkpoints_dir)]
+        tasks_done = [int(m.group(1)) for m in tasks_done if not m is None]
+
+        if len(tasks_done) == 0:
+            return None
+
+        path = os.path.join(checkpoints_dir, f'task-{max(tasks_done)}.pt')
+        self.logger.info(f'Resuming from the task checkpoint: {path}')
+
+        # RNG states must stay on CPU and the memory is not a plain tensors dict,
+        # so we load everything onto CPU and let the trainers move their state to the devices
+        checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+        self.validate_task_checkpoint(checkpoint)
+
+        return checkpoint
+
+    def restore_from_task_checkpoint(self, checkpoint: Dict[str, Any]) -> "TaskTrainer":
+        task_trainer = TASK_TRAINERS[self.config.task_trainer](self, checkpoint['task_idx'])
+        task_trainer.load_state(checkpoint['task_trainer'])
+
+        # Loading the model after the trainer is constructed, since it may reinit the model
+        self.model.load_state_dict(checkpoint['model'])
+        self.logits_history = checkpoint['logits_history']
+        self.train_logits_history = checkpoint['train_logits_history']
+        self.train_accs = checkpoint['train_accs']
+        self.test_accs = checkpoint['test_accs']
+        self.num_tasks_learnt = checkpoint['task_idx'] + 1
+        set_rng_states(checkpoint['rng_states'])
+
+        return task_trainer
+
+    def validate_task_checkpoint(self, checkpoint: Dict[str, Any]):
+        """Refuses to resume from a checkpoint of a differently configured run (e.g. another experiment's one)"""
+        expected = {
+            'num_tasks': self.config.lll_setup.num_tasks,
+            'task_trainer_type': self.config.task_trainer,
+            'hp': self.config.hp.to_dict(),
+        }
+        mismatched = [k for k, v in expected.items() if checkpoint.get(k) != v]
+
+        if len(mismatched) > 0:
+            raise ValueError(f'Task checkpoint does not match the current config (mismatched: {", ".join(mismatched)})')
+
+        if checkpoint['task_idx'] >= self.config.lll_setup.num_tasks:
+            raise ValueError(f'Task checkpoint is for task #{checkpoint["task_idx"]}, but we have only {self.config.lll_setup.num_tasks} tasks')
+
     def checkpoint(self, model_name: str):
         if self.config.get('no_saving'): return
         path = os.path.join(self.paths.checkpoints_path, f'{model_name}.pt')
@@ -259,5 +422,21 @@ class LLLTrainer(BaseTrainer):
 
         return values
 
-    def compute_final_tasks_performance(self) -> np.ndarray:
-        return [compute_acc_for_classes(self.logits_history[-1], self.ds_test.labels, cs, restrict_space=True) for cs in self.class_splits]
+    def compute_final_tasks_performance(self, num_tasks: int=None) -> np.ndarray:
+        class_splits = self.class_splits if num_tasks is None else self.class_splits[:num_tasks]
+
+        return [compute_acc_for_classes(self.logits_history[-1], self.ds_test.labels, cs, restrict_space=True) for cs in class_splits]
+
+    def compute_validation_score(self, metric: str, partial: bool=False) -> float:
+        """
+        Computes the model selection score.
+        A partial score is computed for the tasks learned so far (it is nan when there is not enough tasks for it)
+        """
+        if metric == 'harmonic_mean':
+            values = self.compute_harmonic_mean_accuracy()
+        elif metric == 'final_task_wise_acc':
+            values = self.compute_final_tasks_performance(self.num_tasks_learnt if partial else None)
+        else:
+            raise NotImplementedError('Unknown metric')
+
+        return np.mean(values) if len(values) > 0 else np.nan
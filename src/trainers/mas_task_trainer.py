@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Tuple, List
 
 import torch
 from torch import Tensor
@@ -8,5 +8,7 @@ from src.trainers.ewc_online_task_trainer import EWCOnlineTaskTrainer
 
 
 class MASTaskTrainer(EWCOnlineTaskTrainer):
-    def compute_importances(self, dataloader, output_mask):
-        return compute_mse_grad(self.model, dataloader, output_mask)
+    importance_type = 'mas'
+
+    def compute_importances(self, dataset, output_mask) -> List[Tensor]:
+        return compute_mse_grad(self.model, dataset, output_mask, **self.get_importance_estimation_kwargs())
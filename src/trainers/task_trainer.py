@@ -1,6 +1,6 @@
 import os
 import random
-from typing import List, Tuple, Any
+from typing import List, Tuple, Any, Dict, Callable
 
 import numpy as np
 import torch
@@ -12,8 +12,11 @@ import numpy as np
 from tqdm import tqdm
 from firelab.config import Config
 
-from src.utils.data_utils import construct_output_mask, flatten, remap_targets
-from src.dataloaders.utils import create_custom_dataset
+from src.utils.data_utils import construct_output_mask, flatten, remap_targets, get_dataset_labels, sample_idx_per_class, load_samples
+from src.dataloaders.utils import create_custom_dataset, get_collate_fn, collate_to_tensors
+from src.dataloaders.prefetch_loader import PrefetchLoader
+from src.utils.profiling import log_profiling_stats
+from src.utils.episodic_memory import EpisodicMemory
 from src.utils.training_utils import (
     construct_optimizer,
     prune_logits,
@@ -28,6 +31,8 @@ class TaskTrainer:
         self.main_trainer = main_trainer
         self.device_name = main_trainer.device_name
         self.config = main_trainer.config
+        self.profiler = main_trainer.profiler
+        self.profiling_stats = []
         self.start_task_idx = self.config.get('start_task', 0)
 
         self.init_models()
@@ -71,7 +76,7 @@ class TaskTrainer:
                 self.writer.add_scalar('cls/grad_norm', grad_norm, self.num_iters_done)
 
     def construct_optimizer(self):
-        if self.config.hp.optim.get('reuse') and self.task_idx > 0:
+        if self.config.hp.optim.get('reuse') and self.get_previous_trainer() is not None:
             return self.get_previous_trainer().optim
 
         optim_conf = decrease_lr_in_optim_config(self.config.hp.optim, self.task_idx - self.config.get('start_task', 0))
@@ -85,39 +90,65 @@ class TaskTrainer:
         self.train_dataloader = self.create_dataloader(self.task_ds_train, shuffle=True)
         self.test_dataloader = self.create_dataloader(self.task_ds_test, shuffle=False)
 
-    def create_dataloader(self, dataset: List[Tuple[Any, int]], shuffle: bool, batch_size: int=None):
+    def create_dataloader(self, dataset: List[Tuple[Any, int]], shuffle: bool, batch_size: int=None,
+                          collate_fn: Callable=None) -> PrefetchLoader:
+        """
+        Creates a dataloader, which yields (x, y) tensors already on our device.
+        Batches are collated into tensors by the workers, pinned and copied to the device ahead of time.
+        """
         if batch_size is None:
             batch_size = self.config.hp.batch_size
 
-        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
-                          collate_fn=lambda b: list(zip(*b)), num_workers=4)
+        if collate_fn is None:
+            collate_fn = get_collate_fn(dataset, collate_to_tensors)
 
-    def load_dataset(self, dataset: List[Tuple[Any, int]]):
-        dl = self.create_dataloader(dataset, shuffle=False, batch_size=1)
-        ds = [(x[0], y[0]) for x, y in dl]
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn,
+                                num_workers=4, pin_memory=self.device_name.startswith('cuda'))
 
-        return ds
+        return PrefetchLoader(dataloader, self.device_name, self.config.get('num_prefetch_batches', 2))
+
+    def load_samples(self, dataset: List[Tuple[Any, int]], idx: List[int]=None, classes: List[int]=None) -> Tuple[np.ndarray, np.ndarray]:
+        """Loads the chosen dataset rows into a contiguous array (see `load_samples` in data_utils)"""
+        return load_samples(dataset, idx=idx, classes=classes, batch_size=self.config.get('inference_batch_size', self.config.hp.batch_size))
+
+    def load_memory_samples(self, num_samples_per_class: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Picks up to `num_samples_per_class` samples of each class of the current task
+        using the labels only and then loads just the chosen samples
+        """
+        idx = sample_idx_per_class(get_dataset_labels(self.task_ds_train), num_samples_per_class)
+
+        return self.load_samples(self.task_ds_train, idx=idx)
 
     def compute_loss(self, model: nn.Module, batch: Tuple[Tensor, Tensor]):
         if self.config.hp.use_class_attrs:
-            targets = remap_targets(batch[1], self.seen_classes)
-            x = torch.from_numpy(np.array(batch[0])).to(self.device_name)
-            y = torch.from_numpy(np.array(targets)).to(self.device_name)
+            x, y = batch[0], self.remap_to_seen_classes(batch[1])
+
+            with self.profiler.phase('forward'):
+                logits = model(x, attrs_mask=self.seen_classes_mask)
 
-            logits = model(x, attrs_mask=self.seen_classes_mask)
+                if self.config.task_trainer == 'joint':
+                    pass
+                else:
+                    logits = prune_logits(logits, self.curr_classes_across_seen_mask)
 
-            if self.config.task_trainer == 'joint':
-                pass
-            else:
-                logits = prune_logits(logits, self.curr_classes_across_seen_mask)
+                loss = self.criterion(logits, y)
         else:
-            x = torch.from_numpy(np.array(batch[0])).to(self.device_name)
-            y = torch.from_numpy(np.array(batch[1])).to(self.device_name)
+            x, y = batch
 
-            logits = model(x)
-            logits = prune_logits(logits, self.output_mask)
+            with self.profiler.phase('forward'):
+                logits = model(x)
+                logits = prune_logits(logits, self.output_mask)
+                loss = self.criterion(logits, y)
 
-        return self.criterion(logits, y)
+        return loss
+
+    def remap_to_seen_classes(self, y: Tensor) -> Tensor:
+        """Vectorized version of `remap_targets` for the seen classes"""
+        mapping = torch.full((self.config.lll_setup.num_classes,), -1, dtype=torch.long, device=y.device)
+        mapping[self.seen_classes] = torch.arange(len(self.seen_classes), device=y.device)
+
+        return mapping[y]
 
     def _after_init_hook(self):
         pass
@@ -143,13 +174,37 @@ class TaskTrainer:
 
     def init_episodic_memory(self):
         if self.get_previous_trainer() is None:
-            self.episodic_memory = []
+            self.episodic_memory = self.create_episodic_memory()
         else:
             self.episodic_memory = self.get_previous_trainer().episodic_memory
 
+    def create_episodic_memory(self) -> EpisodicMemory:
+        return EpisodicMemory(
+            max_num_samples=self.config.hp.get('memory.max_num_samples'),
+            max_num_bytes=self.config.hp.get('memory.max_num_bytes'))
+
     def update_episodic_memory(self):
         pass
 
+    def get_state(self) -> Dict[str, Any]:
+        """
+        Returns everything (except the model itself) that is needed
+        to continue the tasks sequence after this trainer has finished
+        """
+        return {
+            'optim': self.optim.state_dict(),
+            'episodic_memory': self.episodic_memory,
+            'num_iters_done': self.num_iters_done,
+            'num_epochs_done': self.num_epochs_done,
+        }
+
+    def load_state(self, state: Dict[str, Any]):
+        """Checkpoints are loaded onto CPU, so we move the state to the devices of the freshly created one"""
+        self.optim.load_state_dict(state['optim']) # Optimizer casts its state to the device of the params
+        self.episodic_memory = state['episodic_memory'].to(self.episodic_memory.device)
+        self.num_iters_done = state['num_iters_done']
+        self.num_epochs_done = state['num_epochs_done']
+
     @property
     def is_trainable(self) -> bool:
         return self.task_idx >= self.config.start_task
@@ -169,14 +224,18 @@ class TaskTrainer:
         epochs = range(1, num_epochs + 1)
         if self._should_tqdm_epochs(): epochs = tqdm(epochs, desc=f'Task #{self.task_idx}')
 
+        if self.profiler.enabled: self.profiler.pop_window_stats() # Dropping what was measured before training
+
         for epoch in epochs:
-            batches = self.train_dataloader
+            # Data and h2d phases are timed by the dataloader itself (only here, not during evaluation)
+            batches = self.train_dataloader.with_profiler(self.profiler)
 
             if not self._should_tqdm_epochs():
                 batches = tqdm(batches, desc=f'Task #{self.task_idx} [epoch {epoch}/{num_epochs}]')
 
             for batch in batches:
                 self.train_on_batch(batch)
+                self.profiler.count_samples(len(batch[0]))
                 self.num_iters_done += 1
                 self.run_after_iter_done_callbacks()
 
@@ -185,6 +244,7 @@ class TaskTrainer:
 
             self.num_epochs_done += 1
             self.on_epoch_done()
+            self.log_profiling_stats()
 
             if self.num_iters_done >= self.config.hp.get('max_num_iters', 100000000):
                 break
@@ -195,15 +255,21 @@ class TaskTrainer:
     def train_on_batch(self, batch):
         raise NotImplementedError
 
+    def log_profiling_stats(self):
+        if not self.profiler.enabled: return
+
+        stats = self.profiler.pop_window_stats()
+        self.profiling_stats.append(stats)
+
+        if not self.config.get('no_saving'):
+            log_profiling_stats(self.writer, stats, self.num_epochs_done)
+
     def compute_accuracy(self, dataloader: DataLoader):
         guessed = []
         self.model.eval()
 
-        with torch.no_grad():
+        with torch.no_grad(), self.profiler.phase('evaluation'):
             for x, y in dataloader:
-                x = torch.from_numpy(np.array(x)).to(self.device_name)
-                y = torch.from_numpy(np.array(y)).to(self.device_name)
-
                 pruned_logits = self.model.compute_pruned_predictions(x, self.output_mask)
 
                 guessed.extend((pruned_logits.argmax(dim=1) == y).cpu().data.tolist())
@@ -220,12 +286,9 @@ class TaskTrainer:
         return self.config.hp.max_num_epochs > 10
 
     def sample_from_memory(self, batch_size: int) -> Tuple[Tensor, Tensor]:
-        samples = random.choices(self.episodic_memory, k=batch_size)
-        x, y = zip(*samples)
-        x = torch.from_numpy(np.array(x)).to(self.device_name)
-        y = torch.tensor(y).to(self.device_name)
+        x, y = self.episodic_memory.sample(batch_size)
 
-        return x, y
+        return x.to(self.device_name), y.to(self.device_name)
 
     def sample_batch(self, dataset: List[Tuple[Any, int]], batch_size: int, replace: bool=False) -> Tuple[np.ndarray, np.ndarray]:
         batch_size = batch_size if replace else min(batch_size, len(dataset))
@@ -16,9 +16,17 @@ from firelab.utils.training_utils import fix_random_seed
 from sklearn.model_selection import train_test_split
 from tqdm import tqdm
 
-from src.utils.training_utils import construct_optimizer, normalize, prune_logits
+from src.utils.training_utils import (
+    construct_optimizer,
+    normalize,
+    prune_logits,
+    create_inference_context,
+    get_logits_storage_dtype,
+    compute_argmax_mismatch_rate
+)
 from src.utils.data_utils import construct_output_mask, remap_targets
 from src.utils.metrics import compute_ausuc
+from src.utils.profiling import Profiler, save_profiling_summary, log_profiling_stats
 from src.models.attrs_head import AttrsHead
 
 
@@ -33,9 +41,15 @@ class ZSLTrainer(BaseTrainer):
         self.random = np.random.RandomState(config.random_seed)
         super().__init__(config)
 
+        create_inference_context(self.device_name, self.config.get('inference_precision', 'float32')) # Failing early on unsupported precisions
         self.prelogits_mean_history = []
         self.prelogits_std_history = []
         self.grads_info_history = {'input': [], 'output': []}
+        self.profiler = Profiler(
+            enabled=self.config.get('profiling.enabled', False),
+            trace=self.config.get('profiling.chrome_trace', False),
+            synchronize_cuda=self.config.get('profiling.synchronize_cuda', False))
+        self.profiling_stats = []
 
     def init_dataloaders(self):
         feats = np.load(f'{self.config.data.dir}/feats.npy').astype(np.float32)
@@ -121,22 +135,28 @@ class ZSLTrainer(BaseTrainer):
         start_time = time()
 
         for epoch in range(1, self.config.hp.max_num_epochs + 1):
-            for batch in self.train_dataloader:
+            for batch in self.profiler.iterate(self.train_dataloader, 'data'):
                 if self.config.logging.save_grads.freq > 0 and self.num_iters_done % self.config.logging.save_grads.freq == 0:
                     self.compute_grads()
 
                 self.train_on_batch(batch)
+                self.profiler.count_samples(len(batch[0]))
                 self.num_iters_done += 1
 
             self.num_epochs_done += 1
 
             if epoch % self.config.val_freq_epochs == 0:
-                self.curr_val_scores = self.validate()
+                with self.profiler.phase('evaluation'):
+                    self.curr_val_scores = self.validate()
                 if not self.config.get('silent'):
                     self.print_scores(self.curr_val_scores, prefix='[CURR VAL] ')
 
             self.scheduler.step()
 
+            if self.profiler.enabled:
+                self.profiling_stats.append(self.profiler.pop_window_stats())
+                log_profiling_stats(self.writer, self.profiling_stats[-1], self.num_epochs_done)
+
         self.print_scores(self.test_scores, prefix='[TEST] ')
         self.print_scores(self.curr_val_scores, prefix='[FINAL VAL] ')
 
@@ -155,34 +175,44 @@ class ZSLTrainer(BaseTrainer):
             np.savez(os.path.join(self.paths.custom_data_path, 'grads_info_history'),
                 input=self.grads_info_history['input'], output=self.grads_info_history['output'])
 
+        if self.profiler.enabled:
+            summary = {'total': self.profiler.get_total_stats(), 'epochs': self.profiling_stats}
+            save_profiling_summary(os.path.join(self.paths.custom_data_path, 'profiling_summary.json'), summary)
+
+            if self.profiler.trace:
+                self.profiler.save_chrome_trace(os.path.join(self.paths.custom_data_path, 'chrome_trace.json'))
+
     def train_on_batch(self, batch):
         self.model.train()
-        feats = torch.from_numpy(np.array(batch[0])).to(self.device_name)
-        labels = torch.from_numpy(np.array(batch[1])).to(self.device_name)
 
-        if self.config.logging.compute_prelogits_stats \
-        or (self.config.logging.save_init_prelogits and self.num_iters_done == 0):
-            logits, prelogits = self.compute_logits(feats, scope='train', return_prelogits=True)
+        with self.profiler.phase('h2d'):
+            feats = torch.from_numpy(np.array(batch[0])).to(self.device_name)
+            labels = torch.from_numpy(np.array(batch[1])).to(self.device_name)
 
-            if self.config.logging.compute_prelogits_stats:
-                self.prelogits_mean_history.append(prelogits.mean().cpu().item())
-                self.prelogits_std_history.append(prelogits.std().cpu().item())
+        with self.profiler.phase('forward'):
+            if self.config.logging.compute_prelogits_stats \
+            or (self.config.logging.save_init_prelogits and self.num_iters_done == 0):
+                logits, prelogits = self.compute_logits(feats, scope='train', return_prelogits=True)
 
-            if self.config.logging.save_init_prelogits and self.num_iters_done == 0:
-                np.save(os.path.join(self.paths.custom_data_path, 'prelogits_initial'), prelogits.detach().cpu().numpy())
-        else:
-            logits = self.compute_logits(feats, scope='train')
+                if self.config.logging.compute_prelogits_stats:
+                    self.prelogits_mean_history.append(prelogits.mean().cpu().item())
+                    self.prelogits_std_history.append(prelogits.std().cpu().item())
 
-        if self.config.hp.get('label_smoothing', 1.0) < 1.0:
-            n_classes = logits.shape[1]
-            other_prob_val = (1 - self.config.hp.label_smoothing) / n_classes
-            targets = torch.ones_like(logits) * other_prob_val
-            targets.scatter_(1, labels.unsqueeze(1), self.config.hp.label_smoothing)
+                if self.config.logging.save_init_prelogits and self.num_iters_done == 0:
+                    np.save(os.path.join(self.paths.custom_data_path, 'prelogits_initial'), prelogits.detach().cpu().numpy())
+            else:
+                logits = self.compute_logits(feats, scope='train')
 
-            log_probs = logits.log_softmax(dim=1)
-            loss = F.kl_div(log_probs, targets, reduction='batchmean')
-        else:
-            loss = F.cross_entropy(logits, labels)
+            if self.config.hp.get('label_smoothing', 1.0) < 1.0:
+                n_classes = logits.shape[1]
+                other_prob_val = (1 - self.config.hp.label_smoothing) / n_classes
+                targets = torch.ones_like(logits) * other_prob_val
+                targets.scatter_(1, labels.unsqueeze(1), self.config.hp.label_smoothing)
+
+                log_probs = logits.log_softmax(dim=1)
+                loss = F.kl_div(log_probs, targets, reduction='batchmean')
+            else:
+                loss = F.cross_entropy(logits, labels)
 
         # if self.config.hp.get('entropy_reg_coef', 0) > 0:
         #     loss -= self.config.hp.entropy_reg_coef * self.compute_entropy_reg(logits)
@@ -191,11 +221,15 @@ class ZSLTrainer(BaseTrainer):
         #     loss -= self.config.hp.cross_entropy_reg_coef * self.compute_cross_entropy_reg(logits)
 
         self.optim.zero_grad()
-        loss.backward()
-        if self.config.hp.get('grad_clip_val', 0) > 0:
-            norm_type = 2 if self.config.hp.grad_clip_norm_type == 'l2' else 'inf'
-            nn.utils.clip_grad_norm_(self.model.parameters(), self.config.hp.grad_clip_val, norm_type)
-        self.optim.step()
+
+        with self.profiler.phase('backward'):
+            loss.backward()
+
+        with self.profiler.phase('optim_step'):
+            if self.config.hp.get('grad_clip_val', 0) > 0:
+                norm_type = 2 if self.config.hp.grad_clip_norm_type == 'l2' else 'inf'
+                nn.utils.clip_grad_norm_(self.model.parameters(), self.config.hp.grad_clip_val, norm_type)
+            self.optim.step()
 
     def compute_grads(self):
         self.model.train()
@@ -264,13 +298,38 @@ class ZSLTrainer(BaseTrainer):
 
         return self.model(feats, attrs_mask=attrs_mask, **model_kwargs)
 
-    def run_inference(self, dataloader: DataLoader, scope: str='all'):
-        with torch.no_grad():
-            logits = [self.compute_logits(x.to(self.device_name), scope).cpu() for x, _ in dataloader]
+    def run_inference(self, dataloader: DataLoader, scope: str='all', precision: str=None):
+        if precision is None:
+            precision = self.config.get('inference_precision', 'float32')
+
+        logits_dtype = get_logits_storage_dtype(precision)
+
+        with torch.no_grad(), create_inference_context(self.device_name, precision):
+            logits = [self.compute_logits(x.to(self.device_name), scope).to(logits_dtype).cpu() for x, _ in dataloader]
         logits = torch.cat(logits, dim=0)
 
+        if precision != 'float32' and self.config.get('inference_agreement_check_size', 0) > 0:
+            self.check_inference_agreement(dataloader, scope, logits, precision)
+
         return logits
 
+    def check_inference_agreement(self, dataloader: DataLoader, scope: str, logits: Tensor, precision: str) -> float:
+        """
+        Reruns inference in float32 on a random subset of the dataloader's data
+        and reports how often the argmax predictions disagree with the reduced-precision ones
+        """
+        dataset = dataloader.dataset
+        num_samples = min(self.config.inference_agreement_check_size, len(dataset))
+        idx = np.random.RandomState(self.config.random_seed).choice(len(dataset), size=num_samples, replace=False)
+        subset_dataloader = DataLoader([dataset[i] for i in idx], batch_size=dataloader.batch_size, num_workers=0)
+        logits_ref = self.run_inference(subset_dataloader, scope, precision='float32')
+        mismatch_rate = compute_argmax_mismatch_rate(logits[idx].float(), logits_ref)
+
+        if not self.config.get('silent'):
+            self.logger.info(f'Argmax mismatch rate ({precision} vs float32, {num_samples} samples): {mismatch_rate: .04f}')
+
+        return mismatch_rate
+
     def compute_scores(self, dataset: str='val'):
         self.model.eval()
 
@@ -1,13 +1,15 @@
 import random
 import warnings
-from typing import List, Tuple, Any
+from typing import List, Tuple, Any, Dict, Iterable
 
 import numpy as np
-from torch.utils.data import Subset
+import torch
+from torch.utils.data import Subset, DataLoader
 from skimage.transform import resize
 from firelab.config import Config
 
-from src.dataloaders.dataset import ImageDataset
+from src.dataloaders.dataset import ImageDataset, ArrayDataset
+from src.dataloaders.utils import get_collate_fn
 
 
 def get_data_splits(class_splits: List[List[int]], dataset: ImageDataset) -> List[ImageDataset]:
@@ -22,15 +24,20 @@ def get_train_test_data_splits(class_splits:List[List[int]], ds_train: ImageData
     return data_splits
 
 
-def get_subset_by_labels(dataset: ImageDataset, labels: List[int]) -> List[int]:
+def get_subset_by_labels(dataset: ImageDataset, labels: List[int]) -> Subset:
     """
     Finds objects with specific labels and returns them
     """
-    subset_labels = set(labels)
-    subset_idx = [i for i, y in enumerate(dataset.labels) if y in subset_labels]
-    subset = Subset(dataset, subset_idx)
+    return subset_by_classes(dataset, labels)
 
-    return subset
+
+def indices_for_classes(dataset: ImageDataset, classes: Iterable[int]) -> np.ndarray:
+    """Finds indices of the objects of the given classes using the labels array only"""
+    return np.nonzero(np.isin(get_dataset_labels(dataset), list(classes)))[0]
+
+
+def subset_by_classes(dataset: ImageDataset, classes: Iterable[int]) -> Subset:
+    return Subset(dataset, indices_for_classes(dataset, classes).tolist())
 
 
 def split_classes_for_tasks(config: Config, random_seed: int) -> List[List[int]]:
@@ -93,16 +100,18 @@ def compute_class_centroids(dataset: "ImageDataset", total_num_classes: int) ->
     """
     assert np.array(dataset[0][0]).ndim == 1, "We should work in features space instead of image space"
 
-    centroids = np.zeros((total_num_classes, len(dataset[0][0])))
-    unique_labels = list(set(dataset.labels))
-    centroids[unique_labels] = [np.mean([x for x, y in dataset if y == l], axis=0) for l in unique_labels] # TODO: this can be done much faster
+    xs = dataset.load_all()[0] if isinstance(dataset, ArrayDataset) else np.array([x for x, _ in dataset])
+    centroids = np.zeros((total_num_classes, xs.shape[1]))
+
+    for c, idx in group_idx_by_class(get_dataset_labels(dataset)).items():
+        centroids[c] = xs[idx].mean(axis=0)
 
     return centroids
 
 
 def filter_out_classes(ds: List[Tuple[np.ndarray, int]], classes_to_keep: List[int]) -> List[Tuple[np.ndarray, int]]:
     """Removes datapoints with classes that are not in `classes_to_keep` list"""
-    return [(x, y) for x, y in ds if y in classes_to_keep]
+    return [ds[i] for i in indices_for_classes(ds, classes_to_keep)]
 
 
 def flatten(list_of_lists: List[List[Any]]) -> List[Any]:
@@ -110,7 +119,7 @@ def flatten(list_of_lists: List[List[Any]]) -> List[Any]:
 
 
 def sample_instances_for_em(ds: ImageDataset, chosen_class: int, size: int) -> ImageDataset:
-    class_idx = [i for i, (_, y) in enumerate(ds) if y == chosen_class]
+    class_idx = indices_for_classes(ds, [chosen_class]).tolist()
     idx_to_add = random.sample(class_idx, min(size, len(class_idx)))
 
     return Subset(ds, idx_to_add)
@@ -125,3 +134,69 @@ def remap_targets(targets: List[int], classes: List[int]) -> List[int]:
     :return: remapped classes
     """
     return [(classes.index(t) if t in classes else -1) for t in targets]
+
+
+def get_dataset_labels(dataset: ImageDataset) -> np.ndarray:
+    """
+    Returns labels of the dataset without touching the inputs (when the dataset knows its labels)
+    """
+    if isinstance(dataset, Subset):
+        return get_dataset_labels(dataset.dataset)[np.array(dataset.indices, dtype=int)]
+    elif hasattr(dataset, 'labels'):
+        return np.array(dataset.labels)
+    else:
+        return np.array([y for _, y in dataset])
+
+
+def group_idx_by_class(labels: np.ndarray) -> Dict[int, np.ndarray]:
+    """
+    Groups dataset indices by their labels in a single sort (indices order is kept inside a group)
+    """
+    labels = np.asarray(labels)
+    order = np.argsort(labels, kind='stable')
+    classes, group_starts = np.unique(labels[order], return_index=True)
+
+    return {c: group for c, group in zip(classes.tolist(), np.split(order, group_starts[1:]))}
+
+
+def sample_idx_per_class(labels: np.ndarray, num_samples_per_class: int) -> np.ndarray:
+    """
+    Samples (without replacement) up to `num_samples_per_class` indices of each class
+    """
+    groups = group_idx_by_class(labels).values()
+    idx = [np.random.permutation(g)[:num_samples_per_class] for g in groups]
+
+    return np.concatenate(idx) if len(idx) > 0 else np.array([], dtype=int)
+
+
+def load_samples(dataset: ImageDataset, idx: Iterable[int]=None, classes: Iterable[int]=None,
+                 batch_size: int=64, num_workers: int=4) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Materializes dataset rows into a contiguous array of inputs and an array of labels.
+    Rows can be selected by indices and/or by classes. Classes are filtered with the label array,
+    so the discarded rows are never loaded. Loading is done in batches by parallel workers.
+    """
+    labels = get_dataset_labels(dataset)
+    idx = np.arange(len(dataset)) if idx is None else np.array(list(idx), dtype=int)
+
+    if not classes is None:
+        idx = idx[np.isin(labels[idx], list(classes))]
+
+    dataloader = DataLoader(Subset(dataset, idx.tolist()), batch_size=batch_size,
+                            collate_fn=get_collate_fn(dataset), num_workers=num_workers)
+    xs = None
+    num_loaded = 0
+
+    for x, _ in dataloader:
+        x = x.numpy() if isinstance(x, torch.Tensor) else np.asarray(x)
+
+        if xs is None:
+            xs = np.empty((len(idx), *x.shape[1:]), dtype=x.dtype)
+
+        xs[num_loaded:num_loaded + len(x)] = x
+        num_loaded += len(x)
+
+    if xs is None:
+        xs = np.empty((0,), dtype=np.float32)
+
+    return xs, labels[idx]
@@ -0,0 +1,237 @@
+from typing import List, Dict, Tuple, Any, Iterable
+
+import numpy as np
+import torch
+from torch import Tensor
+
+
+class EpisodicMemory:
+    """
+    Episodic memory, backed by preallocated contiguous tensors.
+    Occupied slots are always kept packed in [0, len(memory)), so that
+    sampling a batch is a single randint + gather.
+    For each class we keep an insertion-ordered index of its slots.
+
+    The memory is capped either by the number of samples or by the number of bytes.
+    When the cap is reached, new samples overwrite the old ones in a ring order.
+    Without a cap, the storage grows by doubling.
+    """
+    def __init__(self, max_num_samples: int=None, max_num_bytes: int=None, device: str='cpu'):
+        self.max_num_samples = max_num_samples
+        self.max_num_bytes = max_num_bytes
+        self.device = device
+        self.capacity = 0
+        self.size = 0
+        self.ring_pos = 0
+        self.storage = {} # field name => tensor of size [capacity, ...]
+        self.class_slots = {} # class => {slot: None}, we use dict as an ordered set
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def classes(self) -> List[int]:
+        return [c for c, slots in self.class_slots.items() if len(slots) > 0]
+
+    @property
+    def labels(self) -> Tensor:
+        return self.storage['y'][:self.size]
+
+    def to(self, device: str) -> "EpisodicMemory":
+        """Moves the storage to the given device (in-place)"""
+        self.device = device
+        self.storage = {name: storage.to(device) for name, storage in self.storage.items()}
+
+        return self
+
+    def compute_max_capacity(self, sample_num_bytes: int) -> int:
+        max_capacities = [np.inf]
+
+        if not self.max_num_samples is None:
+            max_capacities.append(self.max_num_samples)
+
+        if not self.max_num_bytes is None:
+            max_capacities.append(self.max_num_bytes // sample_num_bytes)
+
+        assert min(max_capacities) > 0, "The memory is too small to keep even a single sample"
+
+        return min(max_capacities)
+
+    def allocate(self, fields: Dict[str, Tensor], num_samples_to_fit: int):
+        """Allocates (or grows) the storage, using the given batch of samples as a template"""
+        sample_num_bytes = sum(v[0].numel() * v.element_size() for v in fields.values())
+        max_capacity = self.compute_max_capacity(sample_num_bytes)
+
+        if self.capacity >= min(num_samples_to_fit, max_capacity):
+            return
+
+        capacity = min(max(num_samples_to_fit, 2 * self.capacity), max_capacity)
+
+        for name, values in fields.items():
+            storage = torch.empty(capacity, *values.shape[1:], dtype=values.dtype, device=self.device)
+
+            if name in self.storage:
+                storage[:self.size] = self.storage[name][:self.size]
+
+            self.storage[name] = storage
+
+        self.capacity = capacity
+
+    def add(self, x: Any, y: int, **extra_fields):
+        self.extend([x], [y], **{k: [v] for k, v in extra_fields.items()})
+
+    def extend(self, xs: Any, ys: Iterable[int], **extra_fields):
+        """
+        Adds a batch of samples. Additional per-sample fields (like output masks) can be passed as kwargs
+        and should be passed for each call.
+        """
+        fields = {k: to_tensor(v) for k, v in {'x': xs, 'y': ys, **extra_fields}.items()}
+        fields['y'] = fields['y'].long()
+        num_samples = len(fields['y'])
+
+        if num_samples == 0:
+            return
+
+        assert all(len(v) == num_samples for v in fields.values())
+        assert self.size == 0 or set(fields.keys()) == set(self.storage.keys()), \
+            f"Wrong fields: {list(fields.keys())} instead of {list(self.storage.keys())}"
+
+        self.allocate(fields, self.size + num_samples)
+
+        if num_samples > self.capacity:
+            # Older samples of the batch would be overwritten anyway
+            fields = {k: v[-self.capacity:] for k, v in fields.items()}
+            num_samples = self.capacity
+
+        num_new = min(self.capacity - self.size, num_samples)
+        num_overwritten = num_samples - num_new
+        overwritten_slots = [(self.ring_pos + i) % self.size for i in range(num_overwritten)]
+        slots = list(range(self.size, self.size + num_new)) + overwritten_slots
+
+        if num_overwritten > 0:
+            self.ring_pos = (self.ring_pos + num_overwritten) % self.size
+
+        for slot in overwritten_slots:
+            self.class_slots[self.storage['y'][slot].item()].pop(slot)
+
+        slots_tensor = torch.tensor(slots, device=self.device)
+
+        for name, values in fields.items():
+            self.storage[name][slots_tensor] = values.to(self.device)
+
+        for slot, y in zip(slots, fields['y'].tolist()):
+            self.class_slots.setdefault(y, {})[slot] = None
+
+        self.size += num_new
+
+    def get_class_slots(self, c: int) -> List[int]:
+        return list(self.class_slots.get(c, {}).keys())
+
+    def sample_idx(self, batch_size: int, replace: bool=True) -> Tensor:
+        assert self.size > 0, "Cannot sample from an empty memory"
+
+        if replace:
+            return torch.randint(self.size, (batch_size,), device=self.device)
+        else:
+            return torch.randperm(self.size, device=self.device)[:batch_size]
+
+    def get(self, idx: Tensor, *fields: str) -> Tuple[Tensor]:
+        fields = fields if len(fields) > 0 else ('x', 'y')
+
+        return tuple(self.storage[f][idx] for f in fields)
+
+    def sample(self, batch_size: int, *fields: str, replace: bool=True) -> Tuple[Tensor]:
+        return self.get(self.sample_idx(batch_size, replace=replace), *fields)
+
+
+def to_tensor(values: Any) -> Tensor:
+    if isinstance(values, Tensor):
+        return values
+    elif isinstance(values, (list, tuple)) and len(values) > 0 and isinstance(values[0], Tensor):
+        return torch.stack(values)
+    else:
+        return torch.as_tensor(np.asarray(values))
+
+
+class ExemplarStore:
+    """
+    Per-class exemplars storage (as in iCaRL): exemplars of each class are kept in a separate row
+    of [num_classes, width, ...] tensors in the order of their rank (i.e. the herding order).
+    This way, reducing the memory to the top-n exemplars of each class is just an update of the counts
+    and each class is available as a view. The rows are compacted when new classes are added.
+    """
+    def __init__(self, device: str='cpu'):
+        self.device = device
+        self.classes = []
+        self.class_to_row = {}
+        self.counts = torch.zeros(0, dtype=torch.long, device=device)
+        self.storage = None # Tensor of size [num_classes, width, ...]
+
+    def __len__(self) -> int:
+        return self.counts.sum().item()
+
+    @property
+    def labels(self) -> Tensor:
+        classes = torch.tensor(self.classes, dtype=torch.long, device=self.device)
+
+        return classes.repeat_interleave(self.counts)
+
+    def to(self, device: str) -> "ExemplarStore":
+        """Moves the storage to the given device (in-place)"""
+        self.device = device
+        self.counts = self.counts.to(device)
+        self.storage = None if self.storage is None else self.storage.to(device)
+
+        return self
+
+    def truncate(self, num_exemplars_per_class: int):
+        """Keeps only the top `num_exemplars_per_class` exemplars of each class"""
+        self.counts.clamp_(max=num_exemplars_per_class)
+
+    def get_class_exemplars(self, c: int) -> Tensor:
+        row = self.class_to_row[c]
+
+        return self.storage[row, :self.counts[row]]
+
+    def extend(self, xs: Any, ys: Iterable[int]):
+        """
+        Adds exemplars of new classes. Exemplars of each class should be given in the order of their rank
+        """
+        xs, ys = to_tensor(xs), to_tensor(ys).long()
+        new_classes = ys.unique().tolist()
+
+        assert len(set(new_classes) & set(self.classes)) == 0, "Adding exemplars to existing classes is not supported"
+
+        new_class_exemplars = [xs[ys == c] for c in new_classes] # Boolean indexing keeps the order
+        old_width = self.counts.max().item() if len(self.classes) > 0 else 0
+        width = max([old_width] + [len(e) for e in new_class_exemplars])
+        storage = torch.zeros(len(self.classes) + len(new_classes), width, *xs.shape[1:], dtype=xs.dtype, device=self.device)
+
+        if len(self.classes) > 0:
+            storage[:len(self.classes), :old_width] = self.storage[:, :old_width]
+
+        for i, exemplars in enumerate(new_class_exemplars):
+            storage[len(self.classes) + i, :len(exemplars)] = exemplars.to(self.device)
+
+        new_counts = torch.tensor([len(e) for e in new_class_exemplars], dtype=torch.long, device=self.device)
+        self.storage = storage
+        self.counts = torch.cat([self.counts, new_counts])
+        self.class_to_row.update({c: len(self.classes) + i for i, c in enumerate(new_classes)})
+        self.classes = self.classes + new_classes
+
+    def sample_idx(self, batch_size: int) -> Tuple[Tensor, Tensor]:
+        """Samples (row, position) pairs uniformly among all the exemplars"""
+        assert len(self) > 0, "Cannot sample from an empty memory"
+
+        counts_cumsum = self.counts.cumsum(dim=0)
+        flat_idx = torch.randint(counts_cumsum[-1].item(), (batch_size,), device=self.device)
+        rows = torch.searchsorted(counts_cumsum, flat_idx, right=True)
+        positions = flat_idx - (counts_cumsum - self.counts)[rows]
+
+        return rows, positions
+
+    def sample(self, batch_size: int) -> Tuple[Tensor, Tensor]:
+        rows, positions = self.sample_idx(batch_size)
+        classes = torch.tensor(self.classes, dtype=torch.long, device=self.device)
+
+        return self.storage[rows, positions], classes[rows]
@@ -0,0 +1,62 @@
+from typing import Dict
+
+import torch
+from torch import Tensor
+
+from src.utils.constants import NEG_INF
+
+
+def select_exemplars_by_herding(feats: Tensor, labels: Tensor, num_exemplars: int) -> Dict[int, Tensor]:
+    """
+    Herding exemplars selection from iCaRL, done for all the classes at once.
+    For each class, we greedily pick the sample which brings the (normalized) mean
+    of the selected samples closest to the (normalized) class mean.
+
+    Instead of recomputing candidate prototypes, we keep a running sum S of the selected features
+    and use that for unit-norm features: ||norm(S + f) - g||^2 = 2 - 2 * <S + f, g> / ||S + f||,
+    where ||S + f||^2 = ||S||^2 + 2<S, f> + 1. So each step is a single batched matvec.
+
+    :param feats: features matrix of size [num_samples, feat_dim] (on any device)
+    :param labels: labels vector of size [num_samples]
+    :param num_exemplars: how many exemplars to select for each class
+    :return: for each class — indices of the selected samples in the order of their selection
+    """
+    assert feats.ndim == 2 and labels.ndim == 1 and len(feats) == len(labels)
+
+    device = feats.device
+    feats = feats / feats.norm(dim=1, keepdim=True)
+    classes, labels_remapped, class_sizes = torch.unique(labels, return_inverse=True, return_counts=True)
+    num_classes, max_class_size = len(classes), class_sizes.max().item()
+    class_range = torch.arange(num_classes, device=device)
+
+    # Packing the features into [num_classes, max_class_size, feat_dim]
+    labels_sorted, order = torch.sort(labels_remapped, stable=True)
+    class_offsets = class_sizes.cumsum(dim=0) - class_sizes
+    positions = torch.arange(len(labels), device=device) - class_offsets[labels_sorted]
+    packed_feats = feats.new_zeros(num_classes, max_class_size, feats.size(1))
+    packed_feats[labels_sorted, positions] = feats[order]
+    packed_idx = torch.full((num_classes, max_class_size), -1, dtype=torch.long, device=device)
+    packed_idx[labels_sorted, positions] = order
+    available = packed_idx >= 0
+
+    prototypes_gold = packed_feats.sum(dim=1) / class_sizes.unsqueeze(1).to(feats.dtype)
+    prototypes_gold = prototypes_gold / prototypes_gold.norm(dim=1, keepdim=True) # [num_classes, feat_dim]
+    feats_dot_gold = torch.bmm(packed_feats, prototypes_gold.unsqueeze(2)).squeeze(2) # [num_classes, max_class_size]
+    running_sum = torch.zeros_like(prototypes_gold) # [num_classes, feat_dim]
+    selected = torch.full((num_classes, min(num_exemplars, max_class_size)), -1, dtype=torch.long, device=device)
+
+    for step in range(selected.size(1)):
+        sum_dot_feats = torch.bmm(packed_feats, running_sum.unsqueeze(2)).squeeze(2) # [num_classes, max_class_size]
+        sum_dot_gold = (running_sum * prototypes_gold).sum(dim=1, keepdim=True) # [num_classes, 1]
+        sum_norms_sq = running_sum.pow(2).sum(dim=1, keepdim=True) # [num_classes, 1]
+        candidates_norms = (sum_norms_sq + 2 * sum_dot_feats + 1).clamp(min=1e-12).sqrt()
+        scores = (sum_dot_gold + feats_dot_gold) / candidates_norms # Cosine similarity with the gold prototype
+        scores.masked_fill_(~available, NEG_INF)
+
+        best_pos = scores.argmax(dim=1) # [num_classes]
+        has_candidates = available[class_range, best_pos]
+        selected[:, step] = torch.where(has_candidates, packed_idx[class_range, best_pos], selected[:, step])
+        available[class_range, best_pos] = False
+        running_sum += packed_feats[class_range, best_pos] * has_candidates.unsqueeze(1).to(feats.dtype)
+
+    return {c: idx[idx >= 0] for c, idx in zip(classes.tolist(), selected)}
@@ -0,0 +1,122 @@
+import os
+import json
+import threading
+from time import perf_counter
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Any
+
+import torch
+
+
+NULL_CONTEXT = nullcontext()
+
+
+class Profiler:
+    """
+    Accumulates wall time spent in the training phases (data wait, host-to-device copy, forward, etc.)
+    and the number of processed samples.
+    Stats are accumulated both in total and in a window, which is reset by `pop_window_stats`
+    (we do this at the end of each epoch). When disabled, `phase` returns a shared no-op context.
+    """
+    def __init__(self, enabled: bool=False, trace: bool=False, synchronize_cuda: bool=False):
+        self.enabled = enabled
+        self.trace = trace
+        self.synchronize_cuda = synchronize_cuda and torch.cuda.is_available()
+        self.trace_events = []
+        self.total_stats = self.init_stats()
+        self.window_stats = self.init_stats()
+        self.window_start_time = perf_counter()
+        self.start_time = self.window_start_time
+
+    def init_stats(self) -> Dict[str, Any]:
+        return {'phases': {}, 'num_samples': 0}
+
+    def phase(self, name: str):
+        if not self.enabled:
+            return NULL_CONTEXT
+
+        return self._timed_phase(name)
+
+    @contextmanager
+    def _timed_phase(self, name: str):
+        if self.synchronize_cuda: torch.cuda.synchronize()
+        start = perf_counter()
+
+        yield
+
+        if self.synchronize_cuda: torch.cuda.synchronize()
+        end = perf_counter()
+
+        for stats in [self.total_stats, self.window_stats]:
+            stats['phases'][name] = stats['phases'].get(name, 0.0) + (end - start)
+
+        if self.trace:
+            self.trace_events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self.start_time) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+            })
+
+    def iterate(self, iterable, name: str='data'):
+        """Wraps an iterable (e.g. a dataloader) to time how long we wait for each next item"""
+        if not self.enabled:
+            return iterable
+
+        return self._timed_iterate(iterable, name)
+
+    def _timed_iterate(self, iterable, name: str):
+        iterator = iter(iterable)
+        sentinel = object()
+
+        while True:
+            with self._timed_phase(name):
+                item = next(iterator, sentinel)
+
+            if item is sentinel:
+                return
+
+            yield item
+
+    def count_samples(self, num_samples: int):
+        if not self.enabled: return
+
+        self.total_stats['num_samples'] += num_samples
+        self.window_stats['num_samples'] += num_samples
+
+    def pop_window_stats(self) -> Dict[str, Any]:
+        stats = self.finalize_stats(self.window_stats, perf_counter() - self.window_start_time)
+        self.window_stats = self.init_stats()
+        self.window_start_time = perf_counter()
+
+        return stats
+
+    def get_total_stats(self) -> Dict[str, Any]:
+        return self.finalize_stats(self.total_stats, perf_counter() - self.start_time)
+
+    def finalize_stats(self, stats: Dict[str, Any], elapsed: float) -> Dict[str, Any]:
+        return {
+            'phases': dict(stats['phases']),
+            'num_samples': stats['num_samples'],
+            'elapsed': elapsed,
+            'samples_per_sec': stats['num_samples'] / max(elapsed, 1e-8),
+        }
+
+    def save_chrome_trace(self, path: os.PathLike):
+        """Saves the trace in Chrome Trace Event format (can be opened in chrome://tracing or Perfetto)"""
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+def save_profiling_summary(path: os.PathLike, summary: Dict[str, Any]):
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+
+def log_profiling_stats(writer: "SummaryWriter", stats: Dict[str, Any], step: int, prefix: str='perf'):
+    writer.add_scalar(f'{prefix}/samples_per_sec', stats['samples_per_sec'], step)
+
+    for phase, duration in stats['phases'].items():
+        writer.add_scalar(f'{prefix}/{phase}_time', duration, step)
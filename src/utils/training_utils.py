@@ -1,3 +1,7 @@
+import random
+from contextlib import nullcontext
+from typing import Dict, Any, Tuple
+
 import numpy as np
 import torch
 import torch.nn as nn
@@ -8,6 +12,12 @@ from firelab.config import Config
 from src.utils.constants import NEG_INF
 
 
+INFERENCE_DTYPES = {
+    'bfloat16': torch.bfloat16,
+    'float16': torch.float16,
+}
+
+
 def validate_clf(clf_model: nn.Module, dataloader, device: str='cpu'):
     losses = []
     accs = []
@@ -92,3 +102,78 @@ def normalize(data: Tensor, scale_value: float=1., detach: bool=False, dim=-1) -
     norms = norms.detach() if detach else norms
 
     return scale_value * (data / norms)
+
+
+def create_inference_context(device_name: str, precision: str='float32'):
+    """
+    Returns a context manager which runs the model in the given precision.
+    For `float32` it is a no-op, otherwise we rely on autocasting (bfloat16 is the one to use on CPU)
+    """
+    if precision == 'float32':
+        return nullcontext()
+
+    if not precision in INFERENCE_DTYPES:
+        raise NotImplementedError(f'Unknown inference precision: {precision}')
+
+    device_type = 'cuda' if device_name.startswith('cuda') else 'cpu'
+
+    if device_type == 'cpu' and precision == 'float16':
+        raise ValueError('float16 inference is not supported on CPU (CPU autocast supports only bfloat16), use bfloat16 instead')
+
+    return torch.autocast(device_type=device_type, dtype=INFERENCE_DTYPES[precision])
+
+
+def get_logits_storage_dtype(precision: str) -> torch.dtype:
+    """Reduced-precision inference keeps the logits in float16 to halve the history size"""
+    return torch.float32 if precision == 'float32' else torch.float16
+
+
+def compute_argmax_mismatch_rate(logits: np.ndarray, logits_ref: np.ndarray) -> float:
+    """
+    Computes a fraction of samples for which the predicted classes differ
+    """
+    preds = np.asarray(logits).argmax(axis=1)
+    preds_ref = np.asarray(logits_ref).argmax(axis=1)
+
+    return (preds != preds_ref).mean().item()
+
+
+def get_rng_states() -> Dict[str, Any]:
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_states(states: Dict[str, Any]):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+
+    if torch.cuda.is_available() and len(states['cuda']) > 0:
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def hash_model_state(model: nn.Module, hasher: "hashlib._Hash"):
+    """Updates the hasher with the model state (i.e. names and raw bytes of all the parameters and buffers)"""
+    for name, value in model.state_dict().items():
+        hasher.update(name.encode())
+        hasher.update(value.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+
+
+def quantize_images(x: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Quantizes a batch of images [N, C, H, W] into uint8 with a per-image per-channel affine transform
+    :return: uint8 images, channel minimums [N, C] and channel scales [N, C]
+    """
+    x_min = x.amin(dim=(2, 3))
+    x_scale = (x.amax(dim=(2, 3)) - x_min).clamp(min=1e-8) / 255
+    x_quantized = ((x - x_min[:, :, None, None]) / x_scale[:, :, None, None]).round_().clamp_(0, 255).to(torch.uint8)
+
+    return x_quantized, x_min, x_scale
+
+
+def dequantize_images(x_quantized: Tensor, x_min: Tensor, x_scale: Tensor) -> Tensor:
+    return x_quantized.float() * x_scale[:, :, None, None] + x_min[:, :, None, None]
@@ -1,85 +1,174 @@
+import os
+import json
+import hashlib
+from typing import List, Callable, Iterable
+
 import numpy as np
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 from torch import Tensor
-import torch.nn as nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset, Subset
 from firelab.utils.training_utils import get_module_device
 
-from src.utils.training_utils import prune_logits
-from src.utils.constants import NEG_INF
+from src.utils.training_utils import prune_logits, hash_model_state
+from src.utils.data_utils import get_dataset_labels, sample_idx_per_class
+from src.dataloaders.utils import get_collate_fn
 
 
-def compute_diagonal_fisher(model: nn.Module, dataloader: DataLoader, output_mask: np.ndarray, normalize_fisher=True) -> Tensor:
+def compute_diagonal_fisher(model: nn.Module, dataset: Dataset, output_mask: np.ndarray,
+                            normalize_fisher=True, **estimation_kwargs) -> List[Tensor]:
     """
     Computes approximate diagonal Fisher matrix
 
     :param model:
-    :param dataloader:
-    :return:
+    :param dataset:
+    :param estimation_kwargs: kwargs for `compute_grad` (samples budget, batch size, etc.)
+    :return: per-parameter Fisher values
     """
-    fisher = compute_grad(model, nn.CrossEntropyLoss(), dataloader, output_mask, 'square')
+    fisher = compute_grad(model, nn.CrossEntropyLoss(), dataset, output_mask, 'square', **estimation_kwargs)
 
     if normalize_fisher:
-        f_min, f_max = fisher.min().item(), fisher.max().item()
-        fisher = (fisher - f_min) / (f_max - f_min)
+        f_min = min(f.min() for f in fisher).item()
+        f_max = max(f.max() for f in fisher).item()
+
+        for f in fisher:
+            f.sub_(f_min).div_(f_max - f_min)
 
     return fisher
 
 
-def compute_mse_grad(model: nn.Module, dataloader: DataLoader, output_mask: np.ndarray) -> Tensor:
+def compute_mse_grad(model: nn.Module, dataset: Dataset, output_mask: np.ndarray, **estimation_kwargs) -> List[Tensor]:
     """
     Computes absolute value of gradient of mse loss
 
     :param model:
-    :param dataloader:
-    :return:
+    :param dataset:
+    :param estimation_kwargs: kwargs for `compute_grad` (samples budget, batch size, etc.)
+    :return: per-parameter importance values
     """
-    mse_criterion = lambda logits, _: logits[logits != NEG_INF].pow(2).sum()
+    # Pruned logits are -inf, so we zero them out (boolean indexing does not work with per-sample grads)
+    mse_criterion = lambda logits, _: torch.where(torch.isinf(logits), torch.zeros_like(logits), logits).pow(2).sum()
 
-    return compute_grad(model, mse_criterion, dataloader, output_mask, 'abs')
+    return compute_grad(model, mse_criterion, dataset, output_mask, 'abs', **estimation_kwargs)
 
 
-def compute_grad(model: nn.Module, criterion: nn.Module, dataloader: DataLoader,
-                 output_mask: np.ndarray, elementwise_grad_norm: str) -> Tensor:
+def compute_grad(model: nn.Module, criterion: Callable, dataset: Dataset, output_mask: np.ndarray,
+                 elementwise_grad_norm: str, num_samples: int=None, batch_size: int=64,
+                 per_sample_grads: bool=False) -> List[Tensor]:
     """
-    Computes gradient of the given loss across the dataset
+    Computes gradient of the given loss across the dataset.
+    Gradients are accumulated per parameter, so the full parameters vector is never materialized.
 
     :param model:
-    :param dataloader:
-    :return:
+    :param dataset:
+    :param num_samples: samples budget (samples are taken uniformly from each class). Uses the whole dataset if None
+    :param per_sample_grads: whether to apply the elementwise norm to per-sample gradients
+        (i.e. the proper empirical Fisher) instead of batch-mean gradients
+    :return: per-parameter gradient norms, averaged over the samples
     """
-    num_samples = 0
-    num_params = sum(p.numel() for p in model.parameters())
+    if not elementwise_grad_norm in ('square', 'abs'):
+        raise NotImplementedError(f'Unknown elementwise grad norm: {elementwise_grad_norm}')
+
     device = get_module_device(model)
-    grad = torch.zeros(num_params).to(device)
+    grad = [torch.zeros_like(p) for p in model.parameters()]
+    num_samples_seen = 0
+    was_training = model.training
+    model.eval() # We do not want to update batchnorm statistics here
 
-    for x, y in dataloader:
+    for x, y in create_importance_dataloader(dataset, num_samples, batch_size):
         x = torch.from_numpy(np.array(x)).to(device)
         y = torch.tensor(y).to(device)
-        logits = model(x)
-        pruned_logits = prune_logits(logits, output_mask)
-        loss = criterion(pruned_logits, y)
-
-        model.zero_grad()
-        loss.backward()
-        curr_grad = torch.cat([get_grad(p).view(-1) for p in model.parameters()])
-
-        if elementwise_grad_norm == 'square':
-            curr_grad = curr_grad.pow(2)
-        elif elementwise_grad_norm == 'abs':
-            curr_grad = curr_grad.abs()
+
+        if per_sample_grads:
+            curr_grad = compute_per_sample_grads(model, criterion, x, y, output_mask)
         else:
-            raise NotImplementedError(f'Unknown elementwise grad norm: {elementwise_grad_norm}')
+            curr_grad = compute_batch_grads(model, criterion, x, y, output_mask)
+
+        for g_acc, g in zip(grad, curr_grad):
+            g_acc.add_((g.pow(2) if elementwise_grad_norm == 'square' else g.abs()).sum(dim=0))
+
+        num_samples_seen += len(x)
+
+    model.train(was_training)
+
+    for g in grad:
+        g.div_(num_samples_seen)
+
+    return grad
+
+
+def compute_batch_grads(model: nn.Module, criterion: Callable, x: Tensor, y: Tensor, output_mask: np.ndarray) -> List[Tensor]:
+    """Computes gradients of the loss over the whole batch. Each gradient has a leading dimension of size 1"""
+    loss = criterion(prune_logits(model(x), output_mask), y)
+
+    model.zero_grad()
+    loss.backward()
+
+    return [get_grad(p).unsqueeze(0) for p in model.parameters()]
+
+
+def compute_per_sample_grads(model: nn.Module, criterion: Callable, x: Tensor, y: Tensor, output_mask: np.ndarray) -> List[Tensor]:
+    """Computes per-sample gradients with a single vectorized pass. Each gradient has size [batch_size, *param.shape]"""
+    params = {name: p.detach() for name, p in model.named_parameters()}
+    buffers = {name: b.detach() for name, b in model.named_buffers()}
 
-        grad += curr_grad
-        num_samples += len(x)
+    def compute_sample_loss(params, x, y):
+        logits = torch.func.functional_call(model, (params, buffers), (x.unsqueeze(0),))
 
-    return grad / num_samples
+        return criterion(prune_logits(logits, output_mask), y.unsqueeze(0))
+
+    grads = torch.func.vmap(torch.func.grad(compute_sample_loss), in_dims=(None, 0, 0))(params, x, y)
+
+    return [grads[name] for name in params]
+
+
+def create_importance_dataloader(dataset: Dataset, num_samples: int=None, batch_size: int=64) -> DataLoader:
+    """Creates a shuffled dataloader over the whole dataset or over its stratified subsample of `num_samples` size"""
+    if not num_samples is None and num_samples < len(dataset):
+        labels = get_dataset_labels(dataset)
+        num_samples_per_class = int(np.ceil(num_samples / len(np.unique(labels))))
+        dataset = Subset(dataset, sample_idx_per_class(labels, num_samples_per_class))
+
+    # Task datasets are stored class by class, so we shuffle them (as the train dataloader does):
+    # otherwise the batches are single-class and the batch gradients are different
+    return DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4,
+                      collate_fn=get_collate_fn(dataset, lambda b: list(zip(*b))))
 
 
 def get_grad(p: nn.Parameter) -> Tensor:
     if p.grad is None: return torch.zeros_like(p)
 
     return p.grad.data
+
+
+def compute_importances_cache_key(model: nn.Module, importance_type: str, classes: Iterable[int],
+                                  output_mask: np.ndarray, **extra_params) -> str:
+    """
+    Computes a key for importances, computed for the given model state on the given classes.
+    Extra params (like a dataset name or estimation kwargs) should be json-serializable
+    """
+    hasher = hashlib.sha1()
+    hash_model_state(model, hasher)
+    hasher.update(json.dumps({
+        'importance_type': importance_type,
+        'classes': sorted(int(c) for c in classes),
+        'output_mask': np.nonzero(output_mask)[0].tolist(),
+        **extra_params,
+    }, sort_keys=True).encode())
+
+    return hasher.hexdigest()
+
+
+def load_cached_importances(cache_dir: os.PathLike, key: str, device: str='cpu') -> List[Tensor]:
+    path = os.path.join(cache_dir, f'{key}.pt')
+
+    return torch.load(path, map_location=device) if os.path.exists(path) else None
+
+
+def save_cached_importances(cache_dir: os.PathLike, key: str, importances: List[Tensor]):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f'{key}.pt')
+    tmp_path = f'{path}.{os.getpid()}.tmp' # Several validation candidates can write the same key
+
+    torch.save([i.cpu() for i in importances], tmp_path)
+    os.replace(tmp_path, path)
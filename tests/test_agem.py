@@ -0,0 +1,27 @@
+import sys; sys.path.append('.')
+
+import torch
+
+from src.trainers.agem_task_trainer import AgemTaskTrainer
+
+
+def project_grad_reference(grad: torch.Tensor, ref_grad: torch.Tensor) -> torch.Tensor:
+    """Projection from the A-GEM paper: g - (g'g_ref / g_ref'g_ref) * g_ref if g'g_ref < 0"""
+    if grad @ ref_grad >= 0:
+        return grad
+
+    return grad - (grad @ ref_grad) / (ref_grad @ ref_grad) * ref_grad
+
+
+def test_project_grad_matches_agem_projection():
+    torch.manual_seed(42)
+
+    for _ in range(20):
+        grad = torch.randn(10, dtype=torch.float64)
+        ref_grad = torch.randn(10, dtype=torch.float64)
+        expected = project_grad_reference(grad, ref_grad)
+
+        AgemTaskTrainer.project_grad(None, grad, ref_grad) # The projection does not use the trainer state
+
+        assert torch.allclose(grad, expected)
+        assert grad @ ref_grad >= -1e-10
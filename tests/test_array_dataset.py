@@ -0,0 +1,35 @@
+import sys; sys.path.append('.')
+
+import numpy as np
+
+from src.dataloaders.dataset import ArrayDataset, ImageDataset
+from src.dataloaders.utils import normalize_imgs, normalize_img
+from src.utils.data_utils import subset_by_classes, indices_for_classes
+
+
+def test_batched_normalization_matches_per_image_one():
+    imgs = np.random.randint(0, 256, size=(4, 8, 6, 3)).astype(np.uint8)
+    expected = np.stack([normalize_img(img).transpose(2, 0, 1) for img in imgs])
+
+    assert np.allclose(normalize_imgs(imgs), expected, atol=1e-5)
+
+
+def test_array_dataset_subsets_do_not_copy_data():
+    data = np.arange(10 * 2).reshape(10, 2)
+    dataset = ArrayDataset(data, np.arange(10) % 3)
+    subset = dataset.filter_out_classes([1, 2]).get_subset([1, 2])
+
+    assert subset.data is data
+    assert subset.labels.tolist() == [2, 1]
+    assert [y for _, y in subset.__getitems__([0, 1])] == [2, 1]
+    assert subset[0][0].tolist() == [4, 5]
+
+
+def test_class_subsets_are_built_from_labels_only():
+    # Image paths do not exist, so any attempt to load an image would fail
+    dataset = ImageDataset([f'missing/{i}.jpg' for i in range(6)], [0, 1, 2, 0, 1, 2])
+    subset = subset_by_classes(dataset, [2, 0])
+
+    assert subset.indices == [0, 2, 3, 5]
+    assert indices_for_classes(subset, [0]).tolist() == [0, 2]
+    assert dataset.subset_by_classes([1]).img_paths == ['missing/1.jpg', 'missing/4.jpg']
@@ -0,0 +1,21 @@
+import sys; sys.path.append('.')
+
+import pytest
+
+from src.dataloaders.utils import describe_transform, create_default_transform, create_resize_transform
+
+
+def test_transforms_are_told_apart():
+    assert describe_transform(create_default_transform((64, 64))) == describe_transform(create_default_transform((64, 64)))
+    assert describe_transform(create_default_transform((64, 64))) != describe_transform(create_default_transform((32, 32)))
+    assert describe_transform(create_default_transform((64, 64))) != describe_transform(create_resize_transform((64, 64)))
+    assert describe_transform(lambda x: x * 2) != describe_transform(lambda x: x * 3)
+
+
+def test_undescribable_transforms_are_rejected():
+    class Transform:
+        def __call__(self, x):
+            return x
+
+    with pytest.raises(ValueError):
+        describe_transform(Transform())
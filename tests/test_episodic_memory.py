@@ -0,0 +1,70 @@
+import sys; sys.path.append('.')
+
+import numpy as np
+import torch
+
+from src.utils.episodic_memory import EpisodicMemory, ExemplarStore
+
+
+def test_memory_indexes_slots_by_class():
+    memory = EpisodicMemory()
+    xs = np.arange(10 * 3).reshape(10, 3).astype(np.float32)
+    ys = np.repeat(np.arange(5), 2)
+    memory.extend(xs, ys)
+
+    assert len(memory) == 10
+    assert memory.get_class_slots(2) == [4, 5]
+    assert sorted(memory.classes) == [0, 1, 2, 3, 4]
+    assert set(memory.labels.tolist()) == {0, 1, 2, 3, 4}
+
+    # Each stored sample should still be consistent with its label
+    for c in memory.classes:
+        for slot in memory.get_class_slots(c):
+            x, y = memory.get(torch.tensor([slot]))
+            assert y.item() == c
+            assert ys[int(x[0, 0].item()) // 3] == c
+
+
+def test_memory_capacity_is_respected():
+    sample_num_bytes = 4 * 4 + 8 # float32 features and int64 label
+    memory = EpisodicMemory(max_num_bytes=sample_num_bytes * 6)
+    memory.extend(np.zeros((4, 4), dtype=np.float32), [0, 0, 0, 0])
+    memory.extend(np.ones((4, 4), dtype=np.float32), [1, 1, 1, 1])
+
+    assert len(memory) == 6
+    assert memory.capacity == 6
+    assert len(memory.get_class_slots(0)) == 2
+    assert len(memory.get_class_slots(1)) == 4
+
+    x, y = memory.sample(100)
+
+    assert x.shape == (100, 4)
+    assert torch.all(x[:, 0] == y.float())
+
+    # The oldest samples are overwritten first
+    memory.extend(np.full((3, 4), 2, dtype=np.float32), [2, 2, 2])
+
+    assert memory.labels.tolist() == [1, 1, 2, 2, 2, 1]
+    assert sorted(memory.classes) == [1, 2]
+    assert memory.get_class_slots(2) == [2, 3, 4]
+
+
+def test_exemplar_store_truncation_keeps_top_exemplars():
+    store = ExemplarStore()
+    store.extend(np.arange(6, dtype=np.float32), [0, 1, 0, 1, 0, 1])
+    store.truncate(2)
+
+    assert len(store) == 4
+    assert store.get_class_exemplars(0).tolist() == [0, 2]
+    assert store.get_class_exemplars(1).tolist() == [1, 3]
+
+    store.extend(np.arange(10, 13, dtype=np.float32), [2, 2, 2])
+
+    assert store.get_class_exemplars(0).tolist() == [0, 2]
+    assert store.get_class_exemplars(2).tolist() == [10, 11, 12]
+    assert sorted(store.labels.tolist()) == [0, 0, 1, 1, 2, 2, 2]
+
+    x, y = store.sample(100)
+    expected_labels = {0: 0, 2: 0, 1: 1, 3: 1, 10: 2, 11: 2, 12: 2}
+
+    assert all(expected_labels[v] == c for v, c in zip(x.long().tolist(), y.tolist()))
@@ -0,0 +1,37 @@
+import sys; sys.path.append('.')
+
+import torch
+
+from src.utils.herding import select_exemplars_by_herding
+
+
+def select_exemplars_naively(feats, num_exemplars):
+    feats = feats / feats.norm(dim=1, keepdim=True)
+    prototype_gold = feats.mean(dim=0)
+    prototype_gold = prototype_gold / prototype_gold.norm()
+    selected = []
+
+    for _ in range(min(num_exemplars, len(feats))):
+        remaining = [i for i in range(len(feats)) if not i in selected]
+        prototypes = (feats[selected].sum(dim=0, keepdim=True) + feats[remaining]) / (len(selected) + 1)
+        prototypes = prototypes / prototypes.norm(dim=1, keepdim=True)
+        distances = (prototypes - prototype_gold.unsqueeze(0)).pow(2).sum(dim=1)
+        selected.append(remaining[distances.argmin().item()])
+
+    return selected
+
+
+def test_herding_matches_naive_implementation():
+    torch.manual_seed(42)
+    feats = torch.randn(100, 16).double()
+    labels = torch.randint(low=0, high=5, size=(100,))
+    labels[:3] = 7 # A class which is smaller than the number of exemplars
+    selected = select_exemplars_by_herding(feats, labels, 10)
+
+    assert sorted(selected.keys()) == sorted(labels.unique().tolist())
+
+    for c, idx in selected.items():
+        class_idx = (labels == c).nonzero().squeeze(1)
+        expected = class_idx[select_exemplars_naively(feats[class_idx], 10)]
+
+        assert idx.tolist() == expected.tolist()
@@ -0,0 +1,16 @@
+import sys; sys.path.append('.')
+
+import pytest
+import torch
+
+from src.utils.training_utils import create_inference_context
+
+
+def test_cpu_inference_runs_in_bfloat16():
+    with create_inference_context('cpu', 'bfloat16'):
+        assert (torch.randn(4, 3) @ torch.randn(3, 2)).dtype == torch.bfloat16
+
+
+def test_float16_is_rejected_on_cpu():
+    with pytest.raises(ValueError):
+        create_inference_context('cpu', 'float16')
@@ -0,0 +1,29 @@
+import sys; sys.path.append('.')
+
+import pytest
+import torch
+
+from src.models.layers import MILayer
+
+
+@pytest.mark.parametrize('x_dim,z_dim,out_dim,rank,chunk_size', [
+    (16, 8, 12, None, None), # Contracting x first
+    (8, 6, 16, None, None), # Contracting the outer product of x and z
+    (12, 16, 8, None, None), # Per-sample weight matrices
+    (16, 8, 12, 4, None), # Low-rank
+    (16, 8, 12, None, 5), # Chunked over out_dim (with an incomplete last chunk)
+])
+def test_einsum_mi_layer_matches_matmul(x_dim, z_dim, out_dim, rank, chunk_size):
+    torch.manual_seed(42)
+    layer = MILayer(x_dim, z_dim, out_dim, rank=rank, chunk_size=chunk_size).double()
+    x = torch.randn(5, x_dim, dtype=torch.float64, requires_grad=True)
+    z = torch.randn(5, z_dim, dtype=torch.float64, requires_grad=True)
+
+    out_einsum = layer(x, z)
+    grads_einsum = torch.autograd.grad(out_einsum.sum(), [x, z] + list(layer.parameters()))
+    layer.impl = 'matmul'
+    out_matmul = layer(x, z)
+    grads_matmul = torch.autograd.grad(out_matmul.sum(), [x, z] + list(layer.parameters()))
+
+    assert torch.allclose(out_einsum, out_matmul)
+    assert all(torch.allclose(g1, g2) for g1, g2 in zip(grads_einsum, grads_matmul))
@@ -0,0 +1,47 @@
+import sys; sys.path.append('.')
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from src.utils.weights_importance import compute_diagonal_fisher
+from src.utils.training_utils import prune_logits
+
+
+def test_per_sample_fisher_matches_naive_computation():
+    torch.manual_seed(42)
+    model = nn.Linear(5, 3)
+    output_mask = np.array([True, True, False])
+    dataset = [(np.random.randn(5).astype(np.float32), i % 2) for i in range(10)]
+
+    fisher = compute_diagonal_fisher(model, dataset, output_mask, normalize_fisher=False, batch_size=4, per_sample_grads=True)
+    fisher_naive = compute_diagonal_fisher(model, dataset, output_mask, normalize_fisher=False, batch_size=1, per_sample_grads=False)
+
+    assert len(fisher) == len(fisher_naive) == 2
+    assert all(f.shape == p.shape for f, p in zip(fisher, model.parameters()))
+    assert all(torch.allclose(f, f_naive, atol=1e-6) for f, f_naive in zip(fisher, fisher_naive))
+
+
+def test_default_fisher_matches_train_dataloader_computation():
+    model = nn.Linear(5, 3)
+    output_mask = np.array([True, True, False])
+    dataset = [(np.random.randn(5).astype(np.float32), i // 5) for i in range(10)] # Stored class by class
+
+    torch.manual_seed(42)
+    fisher = compute_diagonal_fisher(model, dataset, output_mask, normalize_fisher=False, batch_size=4)
+
+    # Squared batch gradients, accumulated over the shuffled train dataloader (as it was before)
+    torch.manual_seed(42)
+    dataloader = DataLoader(dataset, batch_size=4, shuffle=True, collate_fn=lambda b: list(zip(*b)))
+    fisher_expected = [torch.zeros_like(p) for p in model.parameters()]
+
+    for x, y in dataloader:
+        logits = prune_logits(model(torch.from_numpy(np.array(x))), output_mask)
+        model.zero_grad()
+        nn.CrossEntropyLoss()(logits, torch.tensor(y)).backward()
+
+        for f, p in zip(fisher_expected, model.parameters()):
+            f.add_(p.grad.pow(2))
+
+    assert all(torch.allclose(f, f_expected / len(dataset)) for f, f_expected in zip(fisher, fisher_expected))